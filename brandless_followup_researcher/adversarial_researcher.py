@@ -3,7 +3,14 @@ import os
 import streamlit as st
 import time
 import subprocess
-import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.novelty import has_new_information
+from common.output_writer import OutputWriter, is_complete_file, write_atomic, INITIAL_PROMPT
+from common.citation_index import record_citations
 
 # Constants for system prompts
 ONLINE_SYSTEM_PROMPT = """Act as an advocate for the company you are asked about. Conclude your response with a list of URLS used from your search."""
@@ -34,42 +41,75 @@ def send_perplexity_message(conversation_history, model, system_prompt):
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
-    
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        input_tokens = response_data.get('usage', {}).get('prompt_tokens', 0)
-        output_tokens = response_data.get('usage', {}).get('completion_tokens', 0)
-        print(f"Input tokens: {input_tokens}, Output tokens: {output_tokens}")
-        return response_data['choices'][0]['message']['content']
-    else:
-        print(response_data)
-        return "Error: Unable to get a response from the LLM"
-
-def create_conversation(domain, data_type, num_iterations):
-    online_model = "llama-3-sonar-large-32k-online"
-    offline_model = "llama-3-sonar-large-32k-chat"
-    
+    error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+            response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            choices = response_data.get('choices') or [{}]
+            content = choices[0].get('message', {}).get('content')
+            if content and content.strip():
+                input_tokens = response_data.get('usage', {}).get('prompt_tokens', 0)
+                output_tokens = response_data.get('usage', {}).get('completion_tokens', 0)
+                print(f"Input tokens: {input_tokens}, Output tokens: {output_tokens}")
+                return content
+            print(response_data)
+            error = response_data
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+    
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
+
+def send_stage_message(stage, conversation_history, system_prompt):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + "".join(message["content"] for message in conversation_history)
+    error = None
+    for model in route_models(stage, prompt_text):
+        start = time.time()
+        try:
+            return send_perplexity_message(conversation_history, model, system_prompt)
+        except PerplexityError as e:
+            error = e
+        finally:
+            record_latency(model, time.time() - start)
+    raise error
+
+def create_conversation(domain, data_type, num_iterations, early_stop=True):
     online_conversation = []
     offline_conversation = []
     
     # Initial query
-    initial_prompt = f"Answer this question: how does {domain} collect {data_type} data that it sells to advertisers?"
+    initial_prompt = INITIAL_PROMPT.format(domain=domain, data_type=data_type)
     online_conversation.append({"role": "user", "content": initial_prompt})
     
+    previous_responses = []
+    
+    # num_iterations is an upper bound; with early_stop the loop ends once answers stop adding information
     for i in range(num_iterations):
         # Get response from online model
-        online_response = send_perplexity_message(online_conversation, online_model, ONLINE_SYSTEM_PROMPT)
+        online_response = send_stage_message("research", online_conversation, ONLINE_SYSTEM_PROMPT)
         online_conversation.append({"role": "assistant", "content": online_response})
         
         # Update offline conversation
         offline_conversation = online_conversation.copy()
         
+        # Stop once the online model repeats itself without new sources
+        if early_stop and not has_new_information(online_response, previous_responses):
+            print(f"Stopping after {i + 1} of {num_iterations} iterations: no new information")
+            break
+        previous_responses.append(online_response)
+        
         if i < num_iterations - 1:
             # Generate follow-up question using offline model
             follow_up_prompt = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
             offline_conversation.append({"role": "user", "content": follow_up_prompt})
-            follow_up_question = send_perplexity_message(offline_conversation, offline_model, OFFLINE_SYSTEM_PROMPT)
+            follow_up_question = send_stage_message("follow_up", offline_conversation, OFFLINE_SYSTEM_PROMPT)
             
             # Add follow-up question to conversations
             online_conversation.append({"role": "user", "content": follow_up_question})
@@ -85,7 +125,7 @@ def summarize_conversation(initial_prompt, conversation_history):
 
     Summary:"""
     
-    summary = send_perplexity_message([{"role": "user", "content": summary_prompt}], "llama-3-sonar-large-32k-chat", SUMMARY_PROMPT)
+    summary = send_stage_message("summarize", [{"role": "user", "content": summary_prompt}], SUMMARY_PROMPT)
     return summary
 
 def create_markdown_document(initial_prompt, conversation_history):
@@ -100,20 +140,25 @@ def create_markdown_document(initial_prompt, conversation_history):
     
     return markdown
 
-def process_domain_data_type(domain, data_type, num_iterations, output_dir):
+def process_domain_data_type(domain, data_type, num_iterations, output_dir, writer=None):
     filename = f"{domain}_{data_type}.md"
     filepath = os.path.join(output_dir, filename)
     
-    if os.path.exists(filepath):
+    if is_complete_file(filepath):
         print(f"File already exists: {filepath}")
         return filepath
+    if os.path.exists(filepath):
+        print(f"Regenerating incomplete file: {filepath}")
     
     conversation_history, initial_prompt = create_conversation(domain, data_type, num_iterations)
     qa_result = create_markdown_document(initial_prompt, conversation_history)
+    record_citations(domain, data_type, [message["content"] for message in conversation_history if message["role"] == "assistant"])
     time.sleep(10)
     
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(qa_result)
+    if writer is not None:
+        writer.write(filepath, qa_result)
+    else:
+        write_atomic(filepath, qa_result)
     
     return filepath
 
@@ -121,14 +166,15 @@ def process_multiple_domains_data_types(domains, data_types, num_iterations, out
     os.makedirs(output_dir, exist_ok=True)
     results = []
 
-    for domain in domains:
-        for data_type in data_types:
-            try:
-                filepath = process_domain_data_type(domain, data_type, num_iterations, output_dir)
-                results.append((domain, data_type, filepath))
-                print(f"Generated markdown for {domain} - {data_type}: {filepath}")
-            except Exception as e:
-                print(f"Error processing {domain} - {data_type}: {str(e)}")
+    with OutputWriter() as writer:
+        for domain in domains:
+            for data_type in data_types:
+                try:
+                    filepath = process_domain_data_type(domain, data_type, num_iterations, output_dir, writer)
+                    results.append((domain, data_type, filepath))
+                    print(f"Generated markdown for {domain} - {data_type}: {filepath}")
+                except Exception as e:
+                    print(f"Error processing {domain} - {data_type}: {str(e)}")
 
     return results
 
@@ -1,5 +1,14 @@
 import streamlit as st
 import requests
+import time
+import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.novelty import has_new_information
+from common.citation_index import record_citations
 
 # Constants for system prompts
 ONLINE_SYSTEM_PROMPT = """Act as an advocate for the data segment you are asked about. Describe what makes the data accurate and how it was collected. Conclude your response with a list of URLS used from your search."""
@@ -27,19 +36,43 @@ def send_perplexity_message(conversation_history, model, system_prompt):
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
+    error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+            response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            choices = response_data.get('choices') or [{}]
+            content = choices[0].get('message', {}).get('content')
+            if content and content.strip():
+                return content
+            print(response_data)
+            error = response_data
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
     
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        return response_data['choices'][0]['message']['content']
-    else:
-        print(response_data)
-        return "Error: Unable to get a response from the LLM"
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
 
-def create_conversation(data_type, num_iterations=3):
-    online_model = "llama-3-sonar-large-32k-online"
-    offline_model = "llama-3-sonar-large-32k-chat"
-    
+def send_stage_message(stage, conversation_history, system_prompt):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + "".join(message["content"] for message in conversation_history)
+    error = None
+    for model in route_models(stage, prompt_text):
+        start = time.time()
+        try:
+            return send_perplexity_message(conversation_history, model, system_prompt)
+        except PerplexityError as e:
+            error = e
+        finally:
+            record_latency(model, time.time() - start)
+    raise error
+
+def create_conversation(data_type, num_iterations=3, early_stop=True):
     online_conversation = []
     offline_conversation = []
     display_conversation = []
@@ -49,20 +82,28 @@ def create_conversation(data_type, num_iterations=3):
     online_conversation.append({"role": "user", "content": initial_prompt})
     display_conversation.append({"role": "user", "content": initial_prompt})
     
+    previous_responses = []
+    
+    # num_iterations is an upper bound; with early_stop the loop ends once answers stop adding information
     for i in range(num_iterations):
         # Get response from online model
-        online_response = send_perplexity_message(online_conversation, online_model, ONLINE_SYSTEM_PROMPT)
+        online_response = send_stage_message("research", online_conversation, ONLINE_SYSTEM_PROMPT)
         online_conversation.append({"role": "assistant", "content": online_response})
         display_conversation.append({"role": "assistant", "content": online_response})
         
         # Update offline conversation
         offline_conversation = online_conversation.copy()
         
+        # Stop once the online model repeats itself without new sources
+        if early_stop and not has_new_information(online_response, previous_responses):
+            break
+        previous_responses.append(online_response)
+        
         if i < num_iterations - 1:
             # Generate follow-up question using offline model
             follow_up_prompt = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
             offline_conversation.append({"role": "user", "content": follow_up_prompt})
-            follow_up_question = send_perplexity_message(offline_conversation, offline_model, OFFLINE_SYSTEM_PROMPT)
+            follow_up_question = send_stage_message("follow_up", offline_conversation, OFFLINE_SYSTEM_PROMPT)
             
             # Add follow-up question to conversations
             online_conversation.append({"role": "user", "content": follow_up_question})
@@ -79,7 +120,7 @@ def summarize_conversation(initial_prompt, conversation_history):
 
     Summary:"""
     
-    summary = send_perplexity_message([{"role": "user", "content": summary_prompt}], "llama-3-sonar-large-32k-chat", SUMMARY_PROMPT)
+    summary = send_stage_message("summarize", [{"role": "user", "content": summary_prompt}], SUMMARY_PROMPT)
     return summary
 def create_markdown_document(initial_prompt, conversation_history):
     markdown = f"# Adversarial conversation on Question: {initial_prompt}\n\n"
@@ -101,8 +142,14 @@ def main():
     
     if st.button("Get Answer"):
         with st.spinner("Processing..."):
-            conversation_history, initial_prompt = create_conversation(data_type, num_iterations)
-            qa_result = create_markdown_document(initial_prompt, conversation_history)
+            try:
+                conversation_history, initial_prompt = create_conversation(data_type, num_iterations)
+                qa_result = create_markdown_document(initial_prompt, conversation_history)
+                # Brandless research has no broker, so citations are recorded under an empty domain
+                record_citations("", data_type, [message["content"] for message in conversation_history if message["role"] == "assistant"])
+            except PerplexityError as e:
+                st.error(f"Research failed, please try again: {e}")
+                return
         
         st.markdown("## Question-Answer Conversation")
         st.markdown(qa_result)
@@ -0,0 +1 @@
+"""Modules shared by the research tools: routing, budgets, tracing, pipelines and local stores."""
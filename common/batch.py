@@ -0,0 +1,73 @@
+import hashlib
+import os
+import re
+from common.output_writer import write_atomic
+from common.perplexity import PerplexityError
+
+
+def normalize(text):
+    # Topics and subtopics often differ only in case, punctuation or articles
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    return " ".join(word for word in words if word not in ("a", "an", "the"))
+
+
+def unique(items, key=normalize):
+    """The distinct items, in the order first seen."""
+    seen = {}
+    for item in items:
+        seen.setdefault(key(item), item)
+    return list(seen.values())
+
+
+def logged(description, fn, describe=repr):
+    """Wrap a mapped stage's function to report which item's API calls failed.
+
+    The pipeline retries a PerplexityError and then skips the item (None), so one
+    failing item does not stop the rest of the batch.
+    """
+    def call(item):
+        try:
+            return fn(item)
+        except PerplexityError as e:
+            print(f"Failed to {description} {describe(item)}: {e}")
+            raise
+    return call
+
+
+def topic_filepath(output_dir, topic):
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", topic).strip("_")[:80]
+    return os.path.join(output_dir, f"{slug}_{hashlib.sha256(topic.encode()).hexdigest()[:8]}.md")
+
+
+def has_content(content):
+    return bool(content.strip())
+
+
+def write_topic(filepath, content):
+    # Atomic, so an interrupted batch never leaves a partial result to be skipped later
+    write_atomic(filepath, content, is_complete=has_content)
+
+
+def run_topics(pipeline, topics, output_dir, work="items"):
+    """Run a batch pipeline over the topics not written by an earlier run.
+
+    The pipeline takes the "topics" input, lists the distinct research in a "unique" stage and
+    writes each topic from a mapped "summarize" stage returning (topic, filepath). Returns the
+    written pairs; topics that failed are left for the next run.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Duplicate topics are researched once, and topics written by an earlier run are skipped
+    topics = [topic for topic in unique(topic for topic in topics if topic) if not os.path.exists(topic_filepath(output_dir, topic))]
+    if not topics:
+        return []
+
+    def show_progress(stage, result):
+        if stage == "unique":
+            print(f"Researching {len(result)} unique {work} for {len(topics)} topics")
+
+    results = pipeline.run(topics=topics, on_done=show_progress)
+
+    written = [result for result in results["summarize"] if result is not None]
+    if len(written) < len(topics):
+        print(f"{len(topics) - len(written)} topics failed and will be retried by the next run")
+    return written
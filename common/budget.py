@@ -0,0 +1,85 @@
+import threading
+import time
+
+# Share of the budget held back for the final summary; stages start degrading once the rest is used
+SUMMARY_RESERVE = 0.2
+# Once this share of the budget is used, conversation history sent to the model is trimmed
+SHORT_HISTORY_FRACTION = 0.5
+# Number of most recent messages kept (after the first) when trimming history
+SHORT_HISTORY_MESSAGES = 4
+
+
+class RunBudget:
+    """Token, wall-clock and call limits for a single research run.
+
+    Any limit left as None is not enforced. Stages charge every API call to the budget and
+    check near_limit() before starting optional work (another subtopic, another follow-up
+    round) so a run finishes with a summary instead of running away.
+    """
+
+    def __init__(self, max_tokens=None, max_seconds=None, max_calls=None, summary_reserve=SUMMARY_RESERVE):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.max_calls = max_calls
+        self.summary_reserve = summary_reserve
+        self.tokens = 0
+        self.calls = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def charge(self, input_tokens=0, output_tokens=0):
+        with self.lock:
+            self.calls += 1
+            self.tokens += input_tokens + output_tokens
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def used_fraction(self):
+        """The largest share used of any configured limit."""
+        fractions = [0.0]
+        if self.max_tokens:
+            fractions.append(self.tokens / self.max_tokens)
+        if self.max_seconds:
+            fractions.append(self.elapsed() / self.max_seconds)
+        if self.max_calls:
+            fractions.append(self.calls / self.max_calls)
+        return max(fractions)
+
+    def near_limit(self):
+        return self.used_fraction() >= 1 - self.summary_reserve
+
+    def exhausted(self):
+        return self.used_fraction() >= 1
+
+    def calls_left(self, reserved=1):
+        """Calls still available after keeping `reserved` for later stages, or None if calls are unlimited."""
+        if not self.max_calls:
+            return None
+        return max(self.max_calls - self.calls - reserved, 0)
+
+    def limit_items(self, count, reserved=1):
+        """Reduce a planned number of calls (subtopics, subquestions) to what the call limit allows."""
+        left = self.calls_left(reserved)
+        return count if left is None else min(count, left)
+
+    def trim_history(self, conversation):
+        """Keep the first message and the most recent ones once the budget is half spent."""
+        if self.used_fraction() < SHORT_HISTORY_FRACTION or len(conversation) <= SHORT_HISTORY_MESSAGES + 1:
+            return conversation
+        recent = conversation[-SHORT_HISTORY_MESSAGES:]
+        # Perplexity expects user and assistant turns to alternate after the first user message
+        while recent and recent[0]["role"] != "assistant":
+            recent = recent[1:]
+        return conversation[:1] + recent
+
+    def report(self):
+        return {
+            "tokens": self.tokens,
+            "max_tokens": self.max_tokens,
+            "calls": self.calls,
+            "max_calls": self.max_calls,
+            "seconds": round(self.elapsed(), 1),
+            "max_seconds": self.max_seconds,
+            "used_fraction": round(self.used_fraction(), 2)
+        }
@@ -0,0 +1,128 @@
+import argparse
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+from urllib.parse import urlparse
+from common.output_writer import result_identity
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\'\)\]]+')
+
+CITATION_DB = os.environ.get("CITATION_DB", "citations.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS citations (
+    url TEXT NOT NULL,
+    source TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    data_type TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (url, domain, data_type)
+);
+CREATE INDEX IF NOT EXISTS citations_by_source ON citations (source, domain, data_type);
+CREATE INDEX IF NOT EXISTS citations_by_broker ON citations (domain, data_type, timestamp);
+"""
+
+
+def connect(db_path=CITATION_DB):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def extract_citations(text):
+    """Return the URLs cited in a response, in order of first appearance."""
+    urls = []
+    for url in URL_PATTERN.findall(text or ""):
+        url = url.rstrip('.,;:')
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def source_of(url):
+    """The site a URL or bare host belongs to, e.g. 'acxiom.com' for 'https://www.acxiom.com/about' or 'www.acxiom.com'."""
+    # Without a scheme urlparse reads the host as a path
+    host = urlparse(url if "://" in url else f"//{url}").netloc.lower().split(':')[0]
+    return host[4:] if host.startswith("www.") else host
+
+
+def record_citations(domain, data_type, responses, db_path=CITATION_DB):
+    """Store every URL cited across the given responses for a domain and data type."""
+    timestamp = int(time.time())
+    rows = []
+    for response in responses:
+        for url in extract_citations(response):
+            rows.append((url, source_of(url), domain, data_type, timestamp))
+    # sqlite3's own context manager only commits, so close the connection explicitly
+    with closing(connect(db_path)) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO citations (url, source, domain, data_type, timestamp) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+    return len(rows)
+
+
+def brokers_citing(source, db_path=CITATION_DB):
+    """List (domain, data_type, citation count) for every broker whose research cites the source site."""
+    with closing(connect(db_path)) as conn:
+        return conn.execute(
+            "SELECT domain, data_type, COUNT(*) FROM citations WHERE source = ? "
+            "GROUP BY domain, data_type ORDER BY COUNT(*) DESC",
+            (source_of(source),)
+        ).fetchall()
+
+
+def known_sources(domain, data_type=None, limit=10, db_path=CITATION_DB):
+    """Most recently cited URLs for a broker, optionally restricted to one data type."""
+    query = "SELECT url FROM citations WHERE domain = ?"
+    params = [domain]
+    if data_type is not None:
+        query += " AND data_type = ?"
+        params.append(data_type)
+    query += " ORDER BY timestamp DESC LIMIT ?"
+    params.append(limit)
+    with closing(connect(db_path)) as conn:
+        return [row[0] for row in conn.execute(query, params)]
+
+
+def format_sources_context(urls):
+    """Render known sources as an instruction to append to a system prompt."""
+    if not urls:
+        return ""
+    return "\n\nThese sources were useful in earlier research and can be consulted first:\n" + "\n".join(f"- {url}" for url in urls)
+
+
+def backfill_directory(output_dir, db_path=CITATION_DB):
+    """Index citations from existing {domain}_{data_type}.md files."""
+    total = 0
+    for filename in sorted(os.listdir(output_dir)):
+        if not filename.endswith(".md") or "_" not in filename:
+            continue
+        with open(os.path.join(output_dir, filename), 'r', encoding='utf-8') as f:
+            content = f.read()
+        domain, data_type = result_identity(filename, content)
+        total += record_citations(domain, data_type, [content], db_path)
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the citation index built from research outputs.")
+    parser.add_argument("--db", default=CITATION_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("brokers", help="brokers citing a source site").add_argument("source")
+    sources_parser = subparsers.add_parser("sources", help="URLs cited for a broker")
+    sources_parser.add_argument("domain")
+    sources_parser.add_argument("data_type", nargs="?")
+    subparsers.add_parser("backfill", help="index citations from an output directory").add_argument("output_dir")
+    args = parser.parse_args()
+
+    if args.command == "brokers":
+        for domain, data_type, count in brokers_citing(args.source, args.db):
+            print(f"{domain} - {data_type}: {count}")
+    elif args.command == "sources":
+        for url in known_sources(args.domain, args.data_type, limit=100, db_path=args.db):
+            print(url)
+    else:
+        print(f"Indexed {backfill_directory(args.output_dir, args.db)} citations")
@@ -0,0 +1,88 @@
+import json
+import re
+
+# A numbered list item at the start of a line, e.g. "1. text", "2) text" or "**3.** text".
+# Only one or two digit numbers count, so years such as "2023. " are never treated as items.
+NUMBERED_ITEM = re.compile(r'^\s*(?:\*\*)?(\d{1,2})[.)](?:\*\*)?\s+(.+?)\s*$', re.MULTILINE)
+JSON_BLOCK = re.compile(r'(\{.*\}|\[.*\])', re.DOTALL)
+URL_ONLY = re.compile(r'^(?:\[[^\]]*\]\()?<?https?://\S+$')
+
+
+def list_response_format(key, max_items, extra_properties=None):
+    """Build a Perplexity json_schema response_format for an object holding a list of strings under key."""
+    properties = dict(extra_properties or {})
+    properties[key] = {"type": "array", "items": {"type": "string"}, "maxItems": max_items}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties)
+            }
+        }
+    }
+
+
+def parse_json_object(text):
+    """Parse a JSON object or array from a response, tolerating code fences and surrounding prose."""
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        pass
+    match = JSON_BLOCK.search(text or "")
+    if match:
+        try:
+            return json.loads(match.group(1))
+        except ValueError:
+            pass
+    return None
+
+
+def parse_numbered_list(text):
+    """Return the first consecutively numbered list in text.
+
+    Numbering has to start at 1 and increase by one, so numbered lines further
+    down the response (a second list, the URL list, citations) are ignored.
+    """
+    items = []
+    for number, item in NUMBERED_ITEM.findall(text or ""):
+        if int(number) != len(items) + 1:
+            if items:
+                break
+            continue
+        items.append(item)
+    return items
+
+
+def clean_item(item):
+    item = re.sub(r'\*\*|__', '', str(item)).strip().strip('"').strip()
+    return item.rstrip(':').strip()
+
+
+def dedupe(items):
+    seen = set()
+    unique = []
+    for item in items:
+        key = " ".join(item.lower().split()).rstrip('?.')
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(item)
+    return unique
+
+
+def parse_list_response(text, key, max_items=None):
+    """Extract the intended list from a structured response, falling back to a numbered list."""
+    # Only trust JSON that has the expected shape; citation markers such as "[1]" in a
+    # prose answer also parse as JSON and must fall through to the numbered list
+    data = parse_json_object(text)
+    if isinstance(data, dict) and isinstance(data.get(key), list):
+        items = [item for item in data[key] if isinstance(item, str)]
+    elif isinstance(data, list) and data and all(isinstance(item, str) for item in data):
+        items = data
+    else:
+        items = parse_numbered_list(text)
+
+    items = [clean_item(item) for item in items]
+    items = [item for item in items if item and not URL_ONLY.match(item)]
+    return dedupe(items)[:max_items]
@@ -0,0 +1,95 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from common.model_routing import STAGE_ROUTES, RESPONSE_TOKEN_RESERVE, estimate_tokens, model_info
+from common.tracing import span
+from common.perplexity import PerplexityError
+
+# Chunks of a long corpus are condensed at most this many at a time
+MAX_WORKERS = 4
+# Rounds of condensing before the final summary is sent regardless of size
+MAX_LEVELS = 3
+# Attempts at condensing one chunk before it is passed on uncondensed
+CONDENSE_ATTEMPTS = 2
+
+
+def chunk_budget(stage="summarize", overhead_text=""):
+    """Tokens of research that fit in one prompt to the stage's preferred (fastest-fitting) model."""
+    context = model_info(STAGE_ROUTES[stage][0])["context"]
+    return max(context - RESPONSE_TOKEN_RESERVE - estimate_tokens(overhead_text), 256)
+
+
+def split_text(text, max_tokens):
+    """Split a section too long for one prompt at paragraph breaks, cutting paragraphs only if needed."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    max_chars = max_tokens * 4
+    pieces = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > max_chars:
+            pieces.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_sections(sections, max_tokens):
+    """Group sections, in order, into chunks that each fit in max_tokens."""
+    chunks = []
+    current = []
+    size = 0
+    for section in sections:
+        for piece in split_text(section, max_tokens):
+            tokens = estimate_tokens(piece)
+            if current and size + tokens > max_tokens:
+                chunks.append(current)
+                current = []
+                size = 0
+            current.append(piece)
+            size += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def condense_chunk(condense_fn, chunk):
+    """Condense one chunk; if every attempt fails or comes back empty, pass the chunk on as it is."""
+    for _ in range(CONDENSE_ATTEMPTS):
+        try:
+            condensed = condense_fn(chunk)
+        except PerplexityError:
+            continue
+        if condensed and condensed.strip():
+            return condensed
+    return "\n\n".join(chunk)
+
+
+def map_reduce_summary(sections, condense_fn, summarize_fn, stage="summarize", overhead_text="", budget=None):
+    """Summarize sections that may not fit in one prompt to the stage's preferred model.
+
+    While the sections need more than one prompt, each chunk is condensed in parallel with
+    condense_fn(chunk) and the condensed texts become the next round's sections; a chunk
+    that cannot be condensed is kept as it was, so no research is lost to a failed call.
+    The final summarize_fn(sections) call then fits in the preferred model's window. When the run
+    budget cannot pay for the extra calls, everything goes into one call and routing picks
+    a model with a larger window instead.
+    """
+    max_tokens = chunk_budget(stage, overhead_text)
+    for level in range(MAX_LEVELS):
+        chunks = chunk_sections(sections, max_tokens)
+        if len(chunks) <= 1:
+            break
+        calls_left = budget.calls_left(reserved=1) if budget is not None else None
+        if calls_left is not None and calls_left < len(chunks):
+            break
+        with span("summary_map", level=level, chunks=len(chunks)):
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="summary_map") as executor:
+                # Run in the caller's context so tracing spans land in the caller's trace
+                futures = [executor.submit(contextvars.copy_context().run, condense_chunk, condense_fn, chunk) for chunk in chunks]
+                sections = [future.result() for future in futures]
+    return summarize_fn(sections)
@@ -0,0 +1,73 @@
+import streamlit as st
+
+# Context window (tokens) and a starting latency estimate (seconds) for each model we route to,
+# set by each tool's model_routes.py. Latency estimates are refined from observed calls via record_latency.
+MODELS = {}
+
+# Models to try for each pipeline stage, in order of preference. Later entries are
+# fallbacks when a call fails, the prompt does not fit, or the latency budget is tight.
+STAGE_ROUTES = {}
+
+# Per-stage latency budgets in seconds; stages without a budget always keep their preferred model.
+STAGE_LATENCY_BUDGETS = {}
+
+# Tokens kept free in the context window for the model's answer
+RESPONSE_TOKEN_RESERVE = 2048
+
+# Weight given to the newest observation when updating a model's latency estimate
+LATENCY_SMOOTHING = 0.3
+
+
+def configure(models, stage_routes, stage_latency_budgets=None):
+    """Install a tool's model tables, with any overrides from secrets.toml applied on top.
+
+    The tables are updated in place, so modules that imported them see the tool's values.
+    """
+    MODELS.clear()
+    MODELS.update(models)
+    STAGE_ROUTES.clear()
+    STAGE_ROUTES.update(stage_routes)
+    STAGE_ROUTES.update(st.secrets.get("MODEL_ROUTES", {}))
+    STAGE_LATENCY_BUDGETS.clear()
+    STAGE_LATENCY_BUDGETS.update(stage_latency_budgets or {})
+    STAGE_LATENCY_BUDGETS.update(st.secrets.get("MODEL_LATENCY_BUDGETS", {}))
+
+
+def estimate_tokens(text):
+    """Rough token count for routing decisions, assuming about four characters per token."""
+    return len(text) // 4 + 1
+
+
+def model_info(model):
+    return MODELS.get(model, {"tier": "unknown", "context": 8192, "latency": 10.0})
+
+
+def route_models(stage, prompt_text="", latency_budget=None):
+    """Return the models to try for a stage, best first.
+
+    Models whose context window cannot hold the prompt are dropped (unless none fit, in
+    which case the largest window is tried). When the stage has a latency budget, models
+    expected to answer within it are moved ahead of slower ones.
+    """
+    candidates = list(STAGE_ROUTES.get(stage) or [])
+    # Callers loop over the result, so an empty route would fail later with a confusing error
+    if not candidates:
+        raise ValueError(f"No models are routed for stage '{stage}'; check MODEL_ROUTES in secrets.toml")
+    needed = estimate_tokens(prompt_text) + RESPONSE_TOKEN_RESERVE
+    fitting = [model for model in candidates if model_info(model)["context"] >= needed]
+    if not fitting:
+        fitting = sorted(candidates, key=lambda model: model_info(model)["context"], reverse=True)
+
+    if latency_budget is None:
+        latency_budget = STAGE_LATENCY_BUDGETS.get(stage)
+    if latency_budget is not None:
+        fast = [model for model in fitting if model_info(model)["latency"] <= latency_budget]
+        fitting = fast + [model for model in fitting if model not in fast]
+
+    return fitting
+
+
+def record_latency(model, seconds):
+    """Fold an observed call duration into the model's latency estimate."""
+    info = MODELS.setdefault(model, dict(model_info(model)))
+    info["latency"] = (1 - LATENCY_SMOOTHING) * info["latency"] + LATENCY_SMOOTHING * seconds
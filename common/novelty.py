@@ -0,0 +1,43 @@
+import re
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\'\)\]]+')
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+# A follow-up answer counts as new information if it cites at least MIN_NEW_URLS sources
+# not cited before, or if at least MIN_NOVELTY of its word trigrams are new.
+MIN_NEW_URLS = 1
+MIN_NOVELTY = 0.35
+SHINGLE_SIZE = 3
+
+
+def extract_urls(text):
+    """Return the set of URLs in a response, without trailing punctuation."""
+    return {url.rstrip('.,;:') for url in URL_PATTERN.findall(text or "")}
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    # URLs are compared separately, so leave them out of the wording comparison
+    words = WORD_PATTERN.findall(URL_PATTERN.sub(" ", text or "").lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 0))}
+
+
+def novelty_score(response, previous_responses):
+    """Fraction of the response's word trigrams that do not appear in any previous response."""
+    current = shingles(response)
+    if not current:
+        return 0.0
+    seen = set()
+    for previous in previous_responses:
+        seen |= shingles(previous)
+    return len(current - seen) / len(current)
+
+
+def has_new_information(response, previous_responses, min_novelty=MIN_NOVELTY, min_new_urls=MIN_NEW_URLS):
+    """Decide whether a response adds enough over earlier turns to justify another round."""
+    if not previous_responses:
+        return True
+    seen_urls = set()
+    for previous in previous_responses:
+        seen_urls |= extract_urls(previous)
+    new_urls = extract_urls(response) - seen_urls
+    return len(new_urls) >= min_new_urls or novelty_score(response, previous_responses) >= min_novelty
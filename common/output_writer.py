@@ -0,0 +1,110 @@
+import os
+import re
+import tempfile
+import threading
+import time
+
+ERROR_SENTINEL = "Error: Unable to get a response"
+SUMMARY_HEADING = "## Summary for Advertisers"
+
+# The question each '{domain}_{data_type}.md' result answers; it opens the document's title
+INITIAL_PROMPT = "Answer this question: how does {domain} collect {data_type} data that it sells to advertisers?"
+INITIAL_PROMPT_PATTERN = re.compile(r"Answer this question: how does (.+) collect (.+) data that it sells to advertisers\?")
+
+
+def is_complete_output(content):
+    """A result is complete when it has a non-empty summary and no failed LLM turns."""
+    if ERROR_SENTINEL in content or SUMMARY_HEADING not in content:
+        return False
+    summary = content.split(SUMMARY_HEADING, 1)[1].split("\n## ", 1)[0]
+    return bool(summary.strip())
+
+
+def result_identity(filename, content):
+    """The (domain, data_type) a result file was written for.
+
+    Either part may contain "_", so they are read from the question in the document's title;
+    only files without that title fall back to splitting the filename at its last "_".
+    """
+    match = INITIAL_PROMPT_PATTERN.search(content.split("\n", 1)[0])
+    if match:
+        return match.group(1), match.group(2)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if "_" not in stem:
+        return stem, ""
+    return tuple(stem.rsplit("_", 1))
+
+
+def is_complete_file(filepath):
+    """Check whether a previously written result can be trusted by the skip-if-exists resume path."""
+    if not os.path.exists(filepath):
+        return False
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return is_complete_output(f.read())
+
+
+class OutputWriter:
+    """Write result files atomically, sharing fsyncs across files and worker threads.
+
+    Each file is written to a hidden temp file in the target directory. Pending files are
+    fsynced and renamed into place together once fsync_batch_size files are waiting or
+    fsync_interval seconds have passed, and on commit(). A file therefore only appears under
+    its final name after its contents are on disk, so a crash never leaves a partial result.
+    is_complete checks each file's content before it is written; by default it must be a
+    finished advertiser result.
+    """
+
+    def __init__(self, fsync_batch_size=20, fsync_interval=5.0, is_complete=is_complete_output):
+        self.fsync_batch_size = fsync_batch_size
+        self.fsync_interval = fsync_interval
+        self.is_complete = is_complete
+        self.pending = []
+        self.last_commit = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, filepath, content):
+        if not self.is_complete(content):
+            raise ValueError(f"Refusing to write incomplete output: {filepath}")
+
+        directory = os.path.dirname(filepath) or "."
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filepath)}.", suffix=".tmp")
+        f = os.fdopen(fd, 'w', encoding='utf-8')
+        f.write(content)
+        f.flush()
+
+        with self.lock:
+            self.pending.append((f, temp_path, filepath))
+            due = len(self.pending) >= self.fsync_batch_size or time.monotonic() - self.last_commit >= self.fsync_interval
+        if due:
+            self.commit()
+
+    def commit(self):
+        """Fsync and rename every pending file into place."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.last_commit = time.monotonic()
+            directories = set()
+            for f, temp_path, filepath in pending:
+                os.fsync(f.fileno())
+                f.close()
+                os.replace(temp_path, filepath)
+                directories.add(os.path.dirname(filepath) or ".")
+            # Persist the renames themselves
+            for directory in directories:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commit()
+
+
+def write_atomic(filepath, content, is_complete=is_complete_output):
+    """Write a single result file atomically."""
+    with OutputWriter(is_complete=is_complete) as writer:
+        writer.write(filepath, content)
@@ -0,0 +1,8 @@
+# Retries for transient API failures (rate limits, server errors, timeouts)
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 2
+REQUEST_TIMEOUT_SECONDS = 120
+
+
+class PerplexityError(Exception):
+    """Raised when the Perplexity API does not return a usable response after retries."""
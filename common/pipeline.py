@@ -0,0 +1,210 @@
+import contextvars
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from common.tracing import span
+from common.perplexity import PerplexityError
+
+# Independent stages (and the items of a mapped stage) run at most this many at a time
+MAX_WORKERS = 4
+# Results of cached stages are reused across runs and sessions for this long
+CACHE_TTL_SECONDS = 3600
+# Beyond this many cached results, the oldest are dropped
+CACHE_MAX_ENTRIES = 512
+RETRY_BACKOFF_SECONDS = 1
+
+cache = {}
+cache_lock = threading.Lock()
+
+
+def is_cacheable(result):
+    # None marks skipped work, which must not be reused
+    return result is not None
+
+
+def cache_key(name, args):
+    return name, hashlib.sha256(json.dumps(args, sort_keys=True).encode()).hexdigest()
+
+
+def cache_get(key):
+    with cache_lock:
+        hit = cache.get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] >= CACHE_TTL_SECONDS:
+            del cache[key]
+            return None
+        return hit[1]
+
+
+def cache_put(key, result):
+    now = time.time()
+    with cache_lock:
+        # Entries are kept in the order they were stored, so expired ones and the oldest come first
+        cache.pop(key, None)
+        cache[key] = (now, result)
+        while cache:
+            oldest = next(iter(cache))
+            if len(cache) <= CACHE_MAX_ENTRIES and now - cache[oldest][0] < CACHE_TTL_SECONDS:
+                break
+            del cache[oldest]
+
+
+class Node:
+    def __init__(self, name, fn, deps, map_over, retries, cached, max_parallel):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.map_over = map_over
+        self.retries = retries
+        self.cached = cached
+        self.max_parallel = max_parallel
+
+    def needs(self):
+        return self.deps + ((self.map_over,) if self.map_over else ())
+
+    def parallel_limit(self):
+        """How many items of a mapped stage may run at once right now, or None for no limit."""
+        limit = self.max_parallel() if callable(self.max_parallel) else self.max_parallel
+        # Always let one item run so the stage can finish
+        return None if limit is None else max(limit, 1)
+
+    def call(self, *args):
+        """Run the stage once, reusing a cached result and retrying failures.
+
+        A stage still raising after its retries fails the run, except for an item of a mapped
+        stage whose API calls keep failing (PerplexityError), which is skipped (None) like work
+        cut by the budget.
+        """
+        key = cache_key(self.name, args) if self.cached else None
+        if key is not None:
+            hit = cache_get(key)
+            if hit is not None:
+                return hit
+
+        for attempt in range(self.retries + 1):
+            try:
+                with span(self.name):
+                    result = self.fn(*args)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    if self.map_over is not None and isinstance(e, PerplexityError):
+                        return None
+                    raise
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+        if key is not None and is_cacheable(result):
+            cache_put(key, result)
+        return result
+
+
+class Pipeline:
+    """Research stages composed as a DAG and run with independent stages in parallel.
+
+    Each stage's function is called with the results of its deps, in order. A stage added
+    with map_over is called once per item of that stage's result (the item first, then its
+    deps) and its result is the list of those calls' results. A stage starts as soon as
+    everything it needs has finished. Cached stages must take JSON-serializable arguments;
+    bind anything else (e.g. the run budget) into the function itself.
+
+    max_parallel caps how many items of a mapped stage run at once. It may be a function
+    (e.g. budget.calls_left), checked each time an item is started, so later items see what
+    earlier ones charged to the budget instead of all starting against an empty budget.
+    """
+
+    def __init__(self, inputs=(), name="pipeline", max_workers=MAX_WORKERS):
+        self.inputs = tuple(inputs)
+        self.name = name
+        self.max_workers = max_workers
+        self.nodes = {}
+
+    def add(self, name, fn, deps=(), map_over=None, retries=0, cached=False, max_parallel=None):
+        if name in self.nodes or name in self.inputs:
+            raise ValueError(f"Duplicate pipeline stage: {name}")
+        node = Node(name, fn, deps, map_over, retries, cached, max_parallel)
+        # Stages may only depend on inputs and earlier stages, so the graph cannot have cycles
+        unknown = [dep for dep in node.needs() if dep not in self.nodes and dep not in self.inputs]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages: {unknown}")
+        self.nodes[name] = node
+        return self
+
+    def run(self, on_done=None, **inputs):
+        """Run every stage and return all results by stage name.
+
+        on_done(name, result) is called from the calling thread as each stage finishes,
+        so it may update the Streamlit page.
+        """
+        missing = [name for name in self.inputs if name not in inputs]
+        if missing:
+            raise ValueError(f"Missing pipeline inputs: {missing}")
+
+        results = dict(inputs)
+        waiting = dict(self.nodes)
+        running = {}
+        mapped = {}
+        # Items of mapped stages not yet started: name -> (node, deps' results, [(index, item)])
+        queued = {}
+
+        def finish(name, result):
+            results[name] = result
+            if on_done is not None:
+                on_done(name, result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name) as executor:
+            def submit(node, args, index=None):
+                # Run in the caller's context so tracing spans land in the caller's trace
+                future = executor.submit(contextvars.copy_context().run, node.call, *args)
+                running[future] = (node.name, index)
+
+            def start_items(name):
+                node, args, items = queued[name]
+                limit = node.parallel_limit()
+                while items and (limit is None or sum(1 for item_name, _ in running.values() if item_name == name) < limit):
+                    index, item = items.pop(0)
+                    submit(node, [item] + args, index)
+                if not items:
+                    del queued[name]
+
+            try:
+                while waiting or running:
+                    started = True
+                    while started:
+                        started = False
+                        for name, node in list(waiting.items()):
+                            if not all(dep in results for dep in node.needs()):
+                                continue
+                            del waiting[name]
+                            started = True
+                            args = [results[dep] for dep in node.deps]
+                            if node.map_over is None:
+                                submit(node, args)
+                                continue
+                            items = list(results[node.map_over])
+                            if not items:
+                                finish(name, [])
+                                continue
+                            mapped[name] = [None] * len(items)
+                            queued[name] = (node, args, list(enumerate(items)))
+                            start_items(name)
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, index = running.pop(future)
+                        result = future.result()
+                        if index is None:
+                            finish(name, result)
+                            continue
+                        mapped[name][index] = result
+                        if name in queued:
+                            start_items(name)
+                        if name not in queued and not any(item_name == name for item_name, _ in running.values()):
+                            finish(name, mapped.pop(name))
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+        return results
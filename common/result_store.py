@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Shared by every session (and process) on this machine; results are stored once per content
+STORE_DIR = os.environ.get("RESULT_STORE_DIR", os.path.join(tempfile.gettempdir(), "research_results"))
+# Results not read for this long belong to idle sessions and are removed
+IDLE_SECONDS = float(os.environ.get("RESULT_STORE_IDLE_SECONDS", 6 * 3600))
+# Least recently read results are removed once the store grows past this size
+MAX_BYTES = int(os.environ.get("RESULT_STORE_MAX_BYTES", 512 * 1024 * 1024))
+# How often a process sweeps the store for idle results
+SWEEP_INTERVAL_SECONDS = 300
+
+last_sweep = 0.0
+
+
+def path_for(key, store_dir=STORE_DIR):
+    # Two-character fan-out keeps directories small
+    return os.path.join(store_dir, key[:2], key)
+
+
+def touch(path):
+    """Mark an entry as recently used; False if it has been evicted."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def write_entry(key, data, store_dir=STORE_DIR):
+    path = path_for(key, store_dir)
+    if touch(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so concurrent readers never see a partial entry
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{key}.", suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    maybe_sweep(store_dir)
+
+
+def put_bytes(data, store_dir=STORE_DIR):
+    """Store data under its SHA-256 and return the key; identical results are stored once."""
+    key = hashlib.sha256(data).hexdigest()
+    write_entry(key, data, store_dir)
+    return key
+
+
+def get_bytes(key, store_dir=STORE_DIR):
+    """Return the stored data, or None if the key is empty or was evicted."""
+    if not key:
+        return None
+    path = path_for(key, store_dir)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Reading counts as activity, so results of live sessions are not evicted
+    touch(path)
+    return data
+
+
+def put_text(text, store_dir=STORE_DIR):
+    return put_bytes(text.encode('utf-8'), store_dir)
+
+
+def get_text(key, store_dir=STORE_DIR):
+    data = get_bytes(key, store_dir)
+    return data.decode('utf-8') if data is not None else None
+
+
+def put_json(value, store_dir=STORE_DIR):
+    return put_bytes(json.dumps(value, sort_keys=True).encode('utf-8'), store_dir)
+
+
+def get_json(key, store_dir=STORE_DIR):
+    data = get_bytes(key, store_dir)
+    return json.loads(data) if data is not None else None
+
+
+def derived_key(key, kind):
+    """Key for something rendered from a stored result, e.g. its PDF."""
+    return hashlib.sha256(f"{kind}:{key}".encode()).hexdigest()
+
+
+def get_or_render(key, kind, render_fn, store_dir=STORE_DIR):
+    """Return bytes rendered from the result under key, rendering and storing them only once."""
+    rendered_key = derived_key(key, kind)
+    data = get_bytes(rendered_key, store_dir)
+    if data is None:
+        data = render_fn()
+        write_entry(rendered_key, data, store_dir)
+    return data
+
+
+def evict(store_dir=STORE_DIR, idle_seconds=IDLE_SECONDS, max_bytes=MAX_BYTES):
+    """Remove results not read for idle_seconds, then the least recently read until under max_bytes."""
+    now = time.time()
+    entries = []
+    for root, _, files in os.walk(store_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".tmp"):
+                # Another writer may still be filling it; only temp files left by a crashed writer go
+                if now - stat.st_mtime >= idle_seconds:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if now - mtime < idle_seconds and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def maybe_sweep(store_dir=STORE_DIR):
+    global last_sweep
+    if time.monotonic() - last_sweep >= SWEEP_INTERVAL_SECONDS:
+        last_sweep = time.monotonic()
+        evict(store_dir)
@@ -0,0 +1,109 @@
+import os
+import re
+import sqlite3
+import time
+
+SECTION_DB = os.environ.get("SECTION_DB", "sections.sqlite")
+# In refresh mode, sections older than this are researched again
+MAX_AGE_DAYS = float(os.environ.get("SECTION_MAX_AGE_DAYS", 30))
+# In refresh mode, sections scoring below this are researched again whatever their age
+MIN_CONFIDENCE = 0.75
+
+URL_PATTERN = re.compile(r'https?://[^\s)\]>"\']+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    topic TEXT NOT NULL,
+    section TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    content TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (topic, section)
+);
+"""
+
+
+def connect(db_path=SECTION_DB):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executescript(SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def section_key(label):
+    return " ".join(re.findall(r"[a-z0-9]+", label.lower()))
+
+
+def confidence(content):
+    """A rough score for a stored section: empty answers score 0, answers citing no sources 0.5."""
+    if not content or not content.strip():
+        return 0.0
+    return 1.0 if URL_PATTERN.search(content) else 0.5
+
+
+def is_fresh(section, max_age_days=MAX_AGE_DAYS, min_confidence=MIN_CONFIDENCE):
+    age_days = (time.time() - section["timestamp"]) / 86400
+    return age_days <= max_age_days and section["confidence"] >= min_confidence
+
+
+def save_section(topic, section, content, label="", position=0, db_path=SECTION_DB):
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sections (topic, section, position, label, content, confidence, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (topic, section, position, label, content, confidence(content), int(time.time()))
+            )
+    finally:
+        conn.close()
+
+
+def replace_sections(topic, sections, db_path=SECTION_DB, timestamps=None):
+    """Store a topic's sections as (section, label, content) in order, dropping any others.
+
+    timestamps maps sections that were reused unchanged to their original timestamp.
+    """
+    timestamps = timestamps or {}
+    now = int(time.time())
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM sections WHERE topic = ?", (topic,))
+            conn.executemany(
+                "INSERT INTO sections (topic, section, position, label, content, confidence, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(topic, section, position, label, content, confidence(content), timestamps.get(section, now)) for position, (section, label, content) in enumerate(sections)]
+            )
+    finally:
+        conn.close()
+
+
+def load_section(topic, section, db_path=SECTION_DB):
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT * FROM sections WHERE topic = ? AND section = ?", (topic, section)).fetchone()
+        return dict(row) if row is not None else None
+    finally:
+        conn.close()
+
+
+def load_sections(topic, db_path=SECTION_DB):
+    conn = connect(db_path)
+    try:
+        return [dict(row) for row in conn.execute("SELECT * FROM sections WHERE topic = ? ORDER BY position", (topic,))]
+    finally:
+        conn.close()
+
+
+def refreshed(topic, section, research_fn, refresh=False, label="", position=0, db_path=SECTION_DB):
+    """Reuse the stored section when refreshing and it is still fresh; otherwise research and store it."""
+    if refresh:
+        stored = load_section(topic, section, db_path)
+        if stored is not None and is_fresh(stored):
+            return stored["content"]
+    content = research_fn()
+    # Failed calls raise, so a stored section is only ever replaced by a real answer
+    if content is not None:
+        save_section(topic, section, content, label, position, db_path)
+    return content
@@ -0,0 +1,137 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Set RESEARCH_TRACE=1 to record spans process-wide even when no run-level trace is active
+TRACE_ENABLED = os.environ.get("RESEARCH_TRACE", "") not in ("", "0")
+
+current = contextvars.ContextVar("research_trace", default=None)
+
+
+class Trace:
+    """Spans recorded during one research run (or a whole process when RESEARCH_TRACE is set)."""
+
+    def __init__(self, name="research"):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start_ns, end_ns, attributes):
+        with self.lock:
+            self.spans.append({
+                "name": name,
+                "start_ns": start_ns,
+                "end_ns": end_ns,
+                "thread": threading.current_thread().name,
+                "attributes": attributes
+            })
+
+    def timeline(self):
+        """Spans relative to the start of the trace, in milliseconds, for display."""
+        if not self.spans:
+            return []
+        origin = min(span["start_ns"] for span in self.spans)
+        return [
+            {
+                "stage": span["name"],
+                "start_ms": round((span["start_ns"] - origin) / 1e6, 1),
+                "duration_ms": round((span["end_ns"] - span["start_ns"]) / 1e6, 1),
+                "thread": span["thread"],
+                **span["attributes"]
+            }
+            for span in sorted(self.spans, key=lambda span: span["start_ns"])
+        ]
+
+    def to_chrome(self):
+        """Chrome trace event format, viewable in chrome://tracing or Perfetto."""
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start_ns"] / 1000,
+                "dur": (span["end_ns"] - span["start_ns"]) / 1000,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": span["attributes"]
+            })
+        for thread, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_otel(self):
+        """OTLP/JSON trace export, loadable by OpenTelemetry collectors and viewers."""
+        spans = [
+            {
+                "traceId": self.trace_id,
+                "spanId": uuid.uuid4().hex[:16],
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(span["end_ns"]),
+                "attributes": [
+                    {"key": key, "value": {"stringValue": str(value)}}
+                    for key, value in {**span["attributes"], "thread.name": span["thread"]}.items()
+                ]
+            }
+            for span in self.spans
+        ]
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.name}}]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}]
+            }]
+        }
+
+    def export(self, path):
+        """Write the trace to path; files ending in .otlp.json use OTLP, anything else Chrome format."""
+        data = self.to_otel() if path.endswith(".otlp.json") else self.to_chrome()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+
+process_trace = Trace() if TRACE_ENABLED else None
+
+
+@contextmanager
+def start_trace(name="research"):
+    """Record spans from the enclosed code (and work it hands to pipelining threads) into a new Trace."""
+    trace = Trace(name)
+    token = current.set(trace)
+    try:
+        yield trace
+    finally:
+        current.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the enclosed block as a named stage; does nothing when tracing is off."""
+    trace = current.get() or process_trace
+    if trace is None:
+        yield attributes
+        return
+    start_ns = time.time_ns()
+    try:
+        yield attributes
+    finally:
+        trace.add(name, start_ns, time.time_ns(), attributes)
+
+
+def traced(name):
+    """Decorator form of span for whole functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import focused_researcher
+import subquery_focused
+from common.budget import RunBudget
+from common.pipeline import Pipeline
+from common.batch import normalize, unique, logged, topic_filepath, write_topic, run_topics
+from common.citation_index import record_citations
+
+# Which app's prompts to use, and the heading for its research items
+MODES = {
+    "subquestions": (focused_researcher, "Subquestion"),
+    "subqueries": (subquery_focused, "Subquery")
+}
+
+# Topics decompose and research concurrently across the whole batch
+BATCH_MAX_WORKERS = 8
+
+
+def build_batch_pipeline(module, label, output_dir, budget=None):
+    """decompose every topic -> research the unique subquestions once -> summarize and write each topic.
+
+    Subquestions are researched on their own, without their topic, so a subquestion asked by
+    several topics is answered once and shared.
+    """
+    def results_by_topic(topics, question_lists, questions, answers):
+        answer_for = {normalize(q): a for q, a in zip(questions, answers)}
+        results = []
+        for topic, topic_questions in zip(topics, question_lists):
+            if topic_questions is None:
+                print(f"Skipping {topic}: no subquestions")
+                continue
+            answered = [(q, answer_for[normalize(q)]) for q in unique(topic_questions)]
+            results.append((topic, [(q, a) for q, a in answered if a is not None]))
+        return results
+
+    def summarize_and_write(topic_results):
+        # Each topic is written as soon as its summary is in, so a later failure loses nothing
+        topic, results = topic_results
+        summary = module.summarize_research(topic, [q for q, _ in results], [a for _, a in results], budget)
+        filepath = topic_filepath(output_dir, topic)
+        write_topic(filepath, create_topic_document(topic, results, summary, label))
+        # Shared answers are recorded under every topic that used them
+        record_citations(topic, "", [answer for _, answer in results])
+        print(f"Generated markdown for {topic}: {filepath}")
+        return topic, filepath
+
+    pipeline = Pipeline(inputs=("topics",), name="batch", max_workers=BATCH_MAX_WORKERS)
+    pipeline.add("decompose", logged("decompose", lambda topic: module.generate_subquestions(topic, budget)), map_over="topics", retries=1)
+    pipeline.add("unique", lambda question_lists: unique(q for questions in question_lists if questions is not None for q in questions), deps=("decompose",))
+    pipeline.add("research", logged("research", lambda question: module.research_subquestion(question, budget)), map_over="unique", retries=1, cached=True)
+    pipeline.add("results", results_by_topic, deps=("topics", "decompose", "unique", "research"))
+    pipeline.add("summarize", logged("summarize", summarize_and_write, lambda topic_results: repr(topic_results[0])), map_over="results", retries=1)
+    return pipeline
+
+
+def create_topic_document(topic, results, summary, label):
+    markdown = f"# {topic}\n\n## Summary\n\n{summary}\n\n## Research Results\n\n"
+    for i, (question, answer) in enumerate(results, 1):
+        markdown += f"### {label} {i}: {question}\n\n{answer}\n\n"
+    return markdown
+
+
+def run_batch(topics, output_dir, mode="subquestions", budget=None):
+    """Research every topic, sharing work on subquestions that several topics ask, and write one file per topic."""
+    module, label = MODES[mode]
+    return run_topics(build_batch_pipeline(module, label, output_dir, budget), topics, output_dir, mode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Research a file of questions, one per line, in one batch.")
+    parser.add_argument("topics_file")
+    parser.add_argument("--mode", choices=sorted(MODES), default="subquestions")
+    parser.add_argument("--output-dir", default="output_markdown_files")
+    args = parser.parse_args()
+
+    with open(args.topics_file, 'r', encoding='utf-8') as f:
+        topics = [line.strip() for line in f]
+
+    budget = RunBudget()
+    written = run_batch(topics, args.output_dir, args.mode, budget)
+    print(f"\n{len(written)} topics written; budget used: {budget.report()}")
@@ -1,83 +1,172 @@
-import re
+import json
+from contextlib import nullcontext
 import streamlit as st
 import requests
+import time
 from openai import OpenAI
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph
 from reportlab.lib.styles import getSampleStyleSheet
 from io import BytesIO
+import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.budget import RunBudget
+from common.tracing import span, start_trace, traced
+from common.list_parsing import list_response_format, parse_list_response
+from common.result_store import put_json, get_json, put_text, get_text, get_or_render
+from common.pipeline import Pipeline
+from common.map_reduce import map_reduce_summary
+from common.citation_index import record_citations
 
 
-def send_perplexity_message(message, conversation_history, model="llama-3-sonar-large-32k-online", system_prompt=""):
+# Default limits for a research run started from the app, overridable in secrets.toml
+DEFAULT_RUN_BUDGET = {"max_tokens": 60000, "max_seconds": 120, "max_calls": 6}
+
+
+def send_perplexity_message(message, conversation_history, model="llama-3-sonar-large-32k-online", system_prompt="", response_format=None, budget=None):
     url = "https://api.perplexity.ai/chat/completions"
     
-    conversation_history.append({"role": "user", "content": message})
-    
+    question = {"role": "user", "content": message}
     payload = {
         "model": model,
         "messages": [
             {"role": "system", "content": system_prompt}
-        ] + conversation_history
+        ] + conversation_history + [question]
     }
+    if response_format:
+        payload["response_format"] = response_format
     headers = {
         "accept": "application/json",
         "content-type": "application/json",
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
+    error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            with span("perplexity_request", model=model, attempt=attempt):
+                response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+            with span("parse_response"):
+                response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            if budget is not None:
+                usage = response_data.get('usage', {})
+                budget.charge(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+            choices = response_data.get('choices') or [{}]
+            ai_response = choices[0].get('message', {}).get('content')
+            if ai_response and ai_response.strip():
+                # The history only ever grows by answered user/assistant pairs
+                conversation_history.extend([question, {"role": "assistant", "content": ai_response}])
+                print(ai_response)
+                return ai_response
+            error = response_data
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
     
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        ai_response = response_data['choices'][0]['message']['content']
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        print(ai_response)
-        return ai_response
-    else:
-        return "Error: Unable to get a response from the API"
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
+
 
+def send_stage_message(stage, message, conversation_history, system_prompt="", response_format=None, budget=None):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + message + "".join(turn["content"] for turn in conversation_history)
+    error = None
+    with span(stage) as attributes:
+        for model in route_models(stage, prompt_text):
+            attributes["model"] = model
+            start = time.time()
+            try:
+                return send_perplexity_message(message, conversation_history, model=model, system_prompt=system_prompt, response_format=response_format, budget=budget)
+            except PerplexityError as e:
+                error = e
+            finally:
+                record_latency(model, time.time() - start)
+    raise error
 
-def generate_subquestions(main_question):
-    prompt = f"Given the main question '{main_question}', provide three specific subquestions that will help answer the main question. Format the response as a numbered list."
+def generate_subquestions(main_question, budget=None):
+    prompt = f"Given the main question '{main_question}', provide three specific subquestions that will help answer the main question. Respond in JSON with a 'subquestions' list."
     
-    response = send_perplexity_message(
+    response = send_stage_message(
+        "decompose",
         prompt,
         [],
-        model="llama-3-70b-instruct",
-        system_prompt="You are a research assistant."
+        system_prompt="You are a research assistant.",
+        response_format=list_response_format("subquestions", 3),
+        budget=budget
     )
     
-    # Use regex to find numbered items
-    subquestions = re.findall(r'\d+\.\s*(.*)', response)
+    # Read the structured list, falling back to the first numbered list in the response
+    subquestions = parse_list_response(response, "subquestions", 3)
     return subquestions
 
-def research_subquestion(subquestion):
+def research_subquestion(subquestion, budget=None):
     research_prompt = f"Provide a concise answer to the following question: {subquestion}"
     
-    response = send_perplexity_message(
+    response = send_stage_message(
+        "research",
         research_prompt,
         [],
-        model="llama-3-sonar-large-32k-online",
-        system_prompt="Provide a concise and precise answer. Conclude your response with a list of URLS used in the search."
+        system_prompt="Provide a concise and precise answer. Conclude your response with a list of URLS used in the search.",
+        budget=budget
     )
     
     return response
 
-def summarize_research(main_question, subquestions, answers):
-    summary_prompt = f"Summarize the following research to answer the main question: '{main_question}'\n\n"
-    for q, a in zip(subquestions, answers):
-        summary_prompt += f"Subquestion: {q}\nAnswer: {a}\n\n"
-    summary_prompt += "Provide a concise summary that addresses the main question based on this research."
-    
-    summary = send_perplexity_message(
-        summary_prompt,
-        [],
-        model="llama-3-70b-instruct",
-        system_prompt="Synthesize the information and provide a clear, concise summary."
-    )
-    
-    return summary
+def summarize_research(main_question, subquestions, answers, budget=None):
+    system_prompt = "Synthesize the information and provide a clear, concise summary."
+    request_prefix = f"Summarize the following research to answer the main question: '{main_question}'\n\n"
+    request_suffix = "Provide a concise summary that addresses the main question based on this research."
+    sections = [f"Subquestion: {q}\nAnswer: {a}" for q, a in zip(subquestions, answers)]
+
+    def condense(chunk):
+        condense_prompt = f"Extract the information from this part of the research that helps answer the main question: '{main_question}'. Keep specific facts and sources.\n\n" + "\n\n".join(chunk)
+        return send_stage_message("summarize", condense_prompt, [], system_prompt=system_prompt, budget=budget)
+
+    def summarize(chunk):
+        return send_stage_message("summarize", request_prefix + "\n\n".join(chunk) + "\n\n" + request_suffix, [], system_prompt=system_prompt, budget=budget)
+
+    # Research too long for one prompt is condensed in parallel chunks first
+    return map_reduce_summary(sections, condense, summarize, overhead_text=system_prompt + request_prefix + request_suffix, budget=budget)
+
+def build_research_pipeline(budget=None):
+    def decompose(main_question):
+        # Keep one call of the budget for the summary
+        subquestions = generate_subquestions(main_question, budget)
+        if budget is not None:
+            subquestions = subquestions[:budget.limit_items(len(subquestions), reserved=1)]
+        return subquestions
+
+    def research(subquestion):
+        # Skip the remaining subquestions once the budget runs low, leaving room for the summary
+        if budget is not None and budget.near_limit():
+            return None
+        return research_subquestion(subquestion, budget)
 
+    def answered(subquestions, answers):
+        return [(q, a) for q, a in zip(subquestions, answers) if a is not None]
+
+    def summarize(main_question, results):
+        return summarize_research(main_question, [q for q, _ in results], [a for _, a in results], budget)
+
+    pipeline = Pipeline(inputs=("main_question",), name="research")
+    pipeline.add("decompose", decompose, deps=("main_question",), retries=1)
+    # Subquestions are researched in parallel, no more at once than the budget has calls left for,
+    # and reused across runs for the same subquestion
+    pipeline.add("research", research, map_over="decompose", retries=1, cached=True,
+                 max_parallel=budget.calls_left if budget is not None else None)
+    pipeline.add("results", answered, deps=("decompose", "research"))
+    pipeline.add("summarize", summarize, deps=("main_question", "results"))
+    return pipeline
+
+@traced("render_pdf")
 def markdown_to_pdf(markdown_content):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter)
@@ -102,68 +191,96 @@ def markdown_to_pdf(markdown_content):
     buffer.seek(0)
     return buffer
 
+def show_trace_panel(trace):
+    with st.expander("Run timeline"):
+        st.dataframe(trace.timeline())
+        st.download_button(
+            "Download Trace (Chrome JSON)",
+            json.dumps(trace.to_chrome()),
+            file_name="research_trace.json",
+            mime="application/json"
+        )
+
 def main():
     st.title("Focused Research Assistant")
+    show_trace = st.sidebar.checkbox("Show run timeline")
     
-    if 'research_results' not in st.session_state:
-        st.session_state.research_results = None
-    if 'summary' not in st.session_state:
-        st.session_state.summary = None
+    # Results live in the shared result store; session state only holds their keys
+    if 'research_results_key' not in st.session_state:
+        st.session_state.research_results_key = None
+    if 'summary_key' not in st.session_state:
+        st.session_state.summary_key = None
     if 'main_question' not in st.session_state:
         st.session_state.main_question = ""
 
     main_question = st.text_input("Enter your research question:", value=st.session_state.main_question)
     st.session_state.main_question = main_question
 
-    if st.button("Start Research"):
-        try:
-            with st.spinner("Researching..."):
-                # Generate subquestions
-                subquestions = generate_subquestions(main_question)
-                
-                # Research each subquestion
-                answers = []
-                for i, subq in enumerate(subquestions, 1):
-                    st.text(f"Researching subquestion {i}...")
-                    answer = research_subquestion(subq)
-                    answers.append(answer)
+    # Spans are only recorded when the timeline was asked for
+    with (start_trace() if show_trace else nullcontext()) as trace:
+        if st.button("Start Research"):
+            try:
+                with st.spinner("Researching..."):
+                    budget = RunBudget(**st.secrets.get("RUN_BUDGET", DEFAULT_RUN_BUDGET))
                 
-                # Summarize the research
-                summary = summarize_research(main_question, subquestions, answers)
+                    def show_progress(stage, result):
+                        # Called from this thread as each stage finishes
+                        if stage == "decompose":
+                            st.text(f"Researching {len(result)} subquestions...")
+
+                    results = build_research_pipeline(budget).run(main_question=main_question, on_done=show_progress)
+                    # Questions have no data category, so citations are recorded under an empty data_type
+                    record_citations(main_question, "", [answer for _, answer in results["results"]])
+                    st.caption(f"Budget used: {budget.report()}")
                 
-                st.session_state.research_results = list(zip(subquestions, answers))
-                st.session_state.summary = summary
-        except Exception as e:
-            st.error(f"An error occurred during research: {str(e)}")
-
-    # Display results if they exist in session state
-    if st.session_state.research_results:
-        st.markdown("## Research Results")
-        for i, (subq, answer) in enumerate(st.session_state.research_results, 1):
-            st.markdown(f"### Subquestion {i}: {subq}")
-            st.markdown(answer)
+                    st.session_state.research_results_key = put_json(results["results"])
+                    st.session_state.summary_key = put_text(results["summarize"])
+            except Exception as e:
+                st.error(f"An error occurred during research: {str(e)}")
+
+        # Display results if they exist in session state
+        research_results = get_json(st.session_state.research_results_key)
+        summary = get_text(st.session_state.summary_key)
+        if st.session_state.research_results_key and (research_results is None or summary is None):
+            # Evicted after the session sat idle
+            st.info("These research results have expired. Click 'Start Research' to run them again.")
+            st.session_state.research_results_key = None
+            st.session_state.summary_key = None
+        elif research_results:
+            st.markdown("## Research Results")
+            for i, (subq, answer) in enumerate(research_results, 1):
+                st.markdown(f"### Subquestion {i}: {subq}")
+                st.markdown(answer)
         
-        st.markdown("## Summary")
-        st.markdown(st.session_state.summary)
+            st.markdown("## Summary")
+            st.markdown(summary)
         
-        # Create PDF for full research
-        research_content = "# Research Results\n\n" + "\n\n".join([f"## Subquestion: {subq}\n\n{answer}" for subq, answer in st.session_state.research_results])
-        research_pdf = markdown_to_pdf(research_content)
-        st.download_button(
-            "Download Full Research (PDF)", 
-            research_pdf, 
-            file_name=f"{main_question}_full_research.pdf",
-            mime="application/pdf"
-        )
+            # PDFs are rendered once per result and shared by every session showing it
+            research_content = "# Research Results\n\n" + "\n\n".join([f"## Subquestion: {subq}\n\n{answer}" for subq, answer in research_results])
+            research_pdf = get_or_render(
+                st.session_state.research_results_key, "research_pdf",
+                lambda: markdown_to_pdf(research_content).getvalue()
+            )
+            st.download_button(
+                "Download Full Research (PDF)", 
+                research_pdf, 
+                file_name=f"{main_question}_full_research.pdf",
+                mime="application/pdf"
+            )
         
-        # Create PDF for summary
-        summary_pdf = markdown_to_pdf(f"# Summary for '{main_question}'\n\n{st.session_state.summary}")
-        st.download_button(
-            "Download Summary (PDF)", 
-            summary_pdf, 
-            file_name=f"{main_question}_summary.pdf",
-            mime="application/pdf"
-        )
+            summary_pdf = get_or_render(
+                st.session_state.summary_key, f"summary_pdf:{main_question}",
+                lambda: markdown_to_pdf(f"# Summary for '{main_question}'\n\n{summary}").getvalue()
+            )
+            st.download_button(
+                "Download Summary (PDF)", 
+                summary_pdf, 
+                file_name=f"{main_question}_summary.pdf",
+                mime="application/pdf"
+            )
+
+    if trace is not None:
+        show_trace_panel(trace)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,27 @@
+# Models this tool routes to; shared routing logic is in common/model_routing.py.
+# Tools import route_models and record_latency from here so the tables are installed first.
+from common.model_routing import configure, route_models, record_latency
+
+# Context window (tokens) and a starting latency estimate (seconds) for each model
+MODELS = {
+    "llama-3-sonar-small-32k-online": {"tier": "small", "context": 28000, "latency": 6.0},
+    "llama-3-sonar-large-32k-online": {"tier": "large", "context": 28000, "latency": 15.0},
+    "llama-3.1-8b-instruct": {"tier": "small", "context": 131072, "latency": 2.0},
+    "llama-3-70b-instruct": {"tier": "large", "context": 8192, "latency": 8.0},
+    "llama-3.1-70b-instruct": {"tier": "large", "context": 131072, "latency": 10.0},
+}
+
+# Models to try for each pipeline stage, in order of preference. Later entries are
+# fallbacks when a call fails, the prompt does not fit, or the latency budget is tight.
+STAGE_ROUTES = {
+    "decompose": ["llama-3.1-8b-instruct", "llama-3-70b-instruct"],
+    "research": ["llama-3-sonar-large-32k-online", "llama-3-sonar-small-32k-online"],
+    "summarize": ["llama-3-70b-instruct", "llama-3.1-70b-instruct"],
+}
+
+# Per-stage latency budgets in seconds; stages without a budget always keep their preferred model.
+STAGE_LATENCY_BUDGETS = {
+    "decompose": 10.0,
+}
+
+configure(MODELS, STAGE_ROUTES, STAGE_LATENCY_BUDGETS)
@@ -3,7 +3,21 @@ import os
 import streamlit as st
 import time
 import subprocess
-import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.novelty import has_new_information
+from quota_scheduler import acquire, report_rate_limited
+from common.budget import RunBudget
+from common.tracing import span, traced, process_trace
+from pipelining import SpeculativeDraft, read_stream
+from common.output_writer import OutputWriter, is_complete_file, write_atomic, INITIAL_PROMPT
+from search_index import index_document
+from common.citation_index import record_citations, known_sources, format_sources_context, extract_citations
+from export_dataset import DatasetExporter, build_record
+from common.section_store import replace_sections, load_sections, is_fresh
 
 # Constants for system prompts
 ONLINE_SYSTEM_PROMPT = """Act as an advocate for the company you are asked about. Conclude your response with a list of URLS used from your search."""
@@ -12,12 +26,20 @@ OFFLINE_SYSTEM_PROMPT = """You are an AI assistant who is trying to get specific
 from a conversation partner who is connected to the internet. Your **ONLY** concern is the accuracy of the data, because 
 you are investigating on behalf of advertisers who are paying for the data."""
 
+FOLLOW_UP_PROMPT = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
+
 SUMMARY_PROMPT = "Be precise and concise. Only provide the summary, without restating the question, or giving additional context or explanation. Make the summary sound like a natural, human explanation rather than a marketing spiel."    
 
 def prevent_sleep():
     return subprocess.Popen(["caffeinate", "-d", "-i", "-m", "-s"])
 
-def send_perplexity_message(conversation_history, model, system_prompt):
+# Priority of this process when sharing the Perplexity quota with the Streamlit app
+QUOTA_PRIORITY = "batch"
+
+# Default limits for one research run
+DEFAULT_RUN_BUDGET = {"max_tokens": 200000, "max_seconds": 600, "max_calls": 12}
+
+def send_perplexity_message(conversation_history, model, system_prompt, usage=None, on_partial=None, budget=None):
     url = "https://api.perplexity.ai/chat/completions"
     
     messages = [{"role": "system", "content": system_prompt}] + conversation_history
@@ -28,55 +50,168 @@ def send_perplexity_message(conversation_history, model, system_prompt):
         "temperature": 0
     }
     
+    # Stream the answer when the caller wants to see it as it arrives
+    if on_partial is not None:
+        payload["stream"] = True
+    
     headers = {
         "accept": "application/json",
         "content-type": "application/json",
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
+    error = None
+    for attempt in range(MAX_RETRIES):
+        acquire(QUOTA_PRIORITY)
+        try:
+            with span("perplexity_request", model=model, attempt=attempt, streamed=on_partial is not None):
+                response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS, stream=on_partial is not None)
+                if on_partial is not None and response.ok:
+                    response_data = read_stream(response, on_partial)
+            if on_partial is None or not response.ok:
+                with span("parse_response"):
+                    response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            if budget is not None:
+                budget.charge(response_data.get('usage', {}).get('prompt_tokens', 0), response_data.get('usage', {}).get('completion_tokens', 0))
+            choices = response_data.get('choices') or [{}]
+            content = choices[0].get('message', {}).get('content')
+            if content and content.strip():
+                input_tokens = response_data.get('usage', {}).get('prompt_tokens', 0)
+                output_tokens = response_data.get('usage', {}).get('completion_tokens', 0)
+                print(f"Input tokens: {input_tokens}, Output tokens: {output_tokens}")
+                if usage is not None:
+                    usage["input_tokens"] = usage.get("input_tokens", 0) + input_tokens
+                    usage["output_tokens"] = usage.get("output_tokens", 0) + output_tokens
+                return content
+            print(response_data)
+            error = response_data
+            if response.status_code == 429:
+                report_rate_limited()
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
     
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        input_tokens = response_data.get('usage', {}).get('prompt_tokens', 0)
-        output_tokens = response_data.get('usage', {}).get('completion_tokens', 0)
-        print(f"Input tokens: {input_tokens}, Output tokens: {output_tokens}")
-        return response_data['choices'][0]['message']['content']
-    else:
-        print(response_data)
-        return "Error: Unable to get a response from the LLM"
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
 
-def create_conversation(domain, data_type, num_iterations):
-    online_model = "llama-3.1-sonar-large-128k-online"
-    offline_model = "llama-3.1-sonar-large-128k-chat"
-    
+def send_stage_message(stage, conversation_history, system_prompt, usage=None, on_partial=None, budget=None):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + "".join(message["content"] for message in conversation_history)
+    error = None
+    with span(stage) as attributes:
+        for model in route_models(stage, prompt_text):
+            attributes["model"] = model
+            start = time.time()
+            try:
+                return send_perplexity_message(conversation_history, model, system_prompt, usage, on_partial=on_partial, budget=budget)
+            except PerplexityError as e:
+                error = e
+            finally:
+                record_latency(model, time.time() - start)
+    raise error
+
+def generate_follow_up(conversation, usage=None, budget=None):
+    offline_conversation = conversation + [{"role": "user", "content": FOLLOW_UP_PROMPT}]
+    return send_stage_message("follow_up", offline_conversation, OFFLINE_SYSTEM_PROMPT, usage, budget=budget)
+
+def store_conversation(initial_prompt, conversation, timestamps=None):
+    # Each turn is a section: the question is its label and the answer its content
+    turns = [(f"turn {i}", conversation[2 * i]["content"], conversation[2 * i + 1]["content"]) for i in range(len(conversation) // 2)]
+    replace_sections(initial_prompt, turns, timestamps=timestamps)
+
+def resume_conversation(initial_prompt):
+    """The stored conversation up to its first stale turn, for create_conversation to continue.
+
+    Returns (conversation, timestamps, complete). Every turn after a stale one is dropped as
+    well, since its follow-up question was written for the stale answer; the stale turn's own
+    question was written for fresh answers and is kept to be asked again. complete is True
+    when every stored turn is still fresh. Returns (None, None, False) when nothing is stored.
+    """
+    turns = load_sections(initial_prompt)
+    if not turns:
+        return None, None, False
+    conversation = []
+    timestamps = {}
+    for turn in turns:
+        conversation.append({"role": "user", "content": turn["label"]})
+        if not is_fresh(turn):
+            print(f"Reusing {len(timestamps)} of {len(turns)} turns: {initial_prompt}")
+            return conversation, timestamps, False
+        conversation.append({"role": "assistant", "content": turn["content"]})
+        timestamps[turn["section"]] = turn["timestamp"]
+    return conversation, timestamps, True
+
+def create_conversation(domain, data_type, num_iterations, early_stop=True, context_sources=None, usage=None, pipelined=False, budget=None, refresh=False):
+    online_system_prompt = ONLINE_SYSTEM_PROMPT + format_sources_context(context_sources)
     online_conversation = []
     offline_conversation = []
     
     # Initial query
-    initial_prompt = f"Answer this question: how does {domain} collect {data_type} data that it sells to advertisers?"
+    initial_prompt = INITIAL_PROMPT.format(domain=domain, data_type=data_type)
     online_conversation.append({"role": "user", "content": initial_prompt})
     
-    for i in range(num_iterations):
-        # Get response from online model
-        online_response = send_perplexity_message(online_conversation, online_model, ONLINE_SYSTEM_PROMPT)
+    # With refresh, keep the stored turns up to the first stale or low-confidence one and continue from there
+    timestamps = None
+    if refresh:
+        stored_conversation, timestamps, complete = resume_conversation(initial_prompt)
+        if complete:
+            return stored_conversation, initial_prompt
+        if stored_conversation is not None:
+            online_conversation = stored_conversation
+            offline_conversation = online_conversation[:-1]
+    
+    previous_responses = [message["content"] for message in online_conversation if message["role"] == "assistant"]
+    
+    # num_iterations is an upper bound; with early_stop the loop ends once answers stop adding information
+    for i in range(len(online_conversation) // 2, num_iterations):
+        # In pipelined mode, draft the next follow-up question while the answer is still streaming
+        speculation = None
+        if pipelined and i < num_iterations - 1:
+            history = list(online_conversation)
+            speculation = SpeculativeDraft(lambda partial, history=history: generate_follow_up(history + [{"role": "assistant", "content": partial}], usage, budget=budget))
+        
+        # Get response from online model, sending only recent history once the budget is half spent
+        request_history = budget.trim_history(online_conversation) if budget is not None else online_conversation
+        online_response = send_stage_message("research", request_history, online_system_prompt, usage, on_partial=speculation.update if speculation else None, budget=budget)
         online_conversation.append({"role": "assistant", "content": online_response})
         
         # Update offline conversation
         offline_conversation = online_conversation.copy()
         
+        # Stop once the online model repeats itself without new sources
+        if early_stop and not has_new_information(online_response, previous_responses):
+            if speculation is not None:
+                speculation.cancel()
+            print(f"Stopping after {i + 1} of {num_iterations} iterations: no new information")
+            break
+        previous_responses.append(online_response)
+        
+        # Skip further follow-up rounds and go to the summary once the budget runs low
+        if budget is not None and budget.near_limit():
+            if speculation is not None:
+                speculation.cancel()
+            break
+        
         if i < num_iterations - 1:
-            # Generate follow-up question using offline model
-            follow_up_prompt = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
-            offline_conversation.append({"role": "user", "content": follow_up_prompt})
-            follow_up_question = send_perplexity_message(offline_conversation, offline_model, OFFLINE_SYSTEM_PROMPT)
+            # Generate follow-up question using offline model, reusing the speculative draft when it holds up
+            if speculation is not None:
+                follow_up_question = speculation.result(online_response)
+            else:
+                follow_up_question = generate_follow_up(online_conversation, usage, budget=budget)
             
             # Add follow-up question to conversations
             online_conversation.append({"role": "user", "content": follow_up_question})
     
+    # Reused turns keep their original timestamps so they still age out on schedule
+    store_conversation(initial_prompt, offline_conversation, timestamps)
+    
     return offline_conversation, initial_prompt
 
-def summarize_conversation(initial_prompt, conversation_history):
+def summarize_conversation(initial_prompt, conversation_history, usage=None, budget=None):
     summary_prompt = f"""Based on the following conversation about '{initial_prompt}', provide a concise summary for a non-technical advertiser. 
     Focus on answering the initial question and find a single answer to satisfy the question. Keep it brief and easy to understand.
 
@@ -85,50 +220,80 @@ def summarize_conversation(initial_prompt, conversation_history):
 
     Summary:"""
     
-    summary = send_perplexity_message([{"role": "user", "content": summary_prompt}], "llama-3-sonar-large-32k-chat", SUMMARY_PROMPT)
+    summary = send_stage_message("summarize", [{"role": "user", "content": summary_prompt}], SUMMARY_PROMPT, usage, budget=budget)
     return summary
 
-def create_markdown_document(initial_prompt, conversation_history):
+@traced("render_markdown")
+def create_markdown_document(initial_prompt, conversation_history, summary=None):
     markdown = f"# Adversarial conversation on Question: {initial_prompt}\n\n"
     for message in conversation_history:
         role = "Online Model" if message["role"] == "assistant" else "Offline Model"
         markdown += f"## {role}\n\n{message['content']}\n\n"
     
     # Add summary section
-    summary = summarize_conversation(initial_prompt, conversation_history)
+    if summary is None:
+        summary = summarize_conversation(initial_prompt, conversation_history)
     markdown += f"## Summary for Advertisers\n\n{summary}\n"
     
     return markdown
 
-def process_domain_data_type(domain, data_type, num_iterations, output_dir):
+def process_domain_data_type(domain, data_type, num_iterations, output_dir, exporter=None, writer=None, refresh=False):
     filename = f"{domain}_{data_type}.md"
     filepath = os.path.join(output_dir, filename)
     
-    if os.path.exists(filepath):
+    # A refresh rewrites complete files too, re-asking only the stale parts of their conversations
+    if is_complete_file(filepath) and not refresh:
+        # Existing results were exported by the run that wrote them; files from before the
+        # dataset existed can be added with `python export_dataset.py <output_dir> <path>`
         print(f"File already exists: {filepath}")
         return filepath
+    if os.path.exists(filepath):
+        print(f"Regenerating incomplete file: {filepath}")
     
-    conversation_history, initial_prompt = create_conversation(domain, data_type, num_iterations)
-    qa_result = create_markdown_document(initial_prompt, conversation_history)
+    # Sources already cited for this broker are offered as a starting point for the search
+    context_sources = known_sources(domain)
+    usage = {}
+    budget = RunBudget(**DEFAULT_RUN_BUDGET)
+    conversation_history, initial_prompt = create_conversation(domain, data_type, num_iterations, context_sources=context_sources, usage=usage, budget=budget, refresh=refresh)
+    summary = summarize_conversation(initial_prompt, conversation_history, usage, budget)
+    print(f"Budget used for {domain} - {data_type}: {budget.report()}")
+    qa_result = create_markdown_document(initial_prompt, conversation_history, summary)
+    answers = [message["content"] for message in conversation_history if message["role"] == "assistant"]
+    record_citations(domain, data_type, answers)
     time.sleep(10)
     
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(qa_result)
+    if writer is not None:
+        writer.write(filepath, qa_result)
+    else:
+        write_atomic(filepath, qa_result)
+    index_document(filepath, qa_result, domain, data_type)
+    
+    if exporter is not None:
+        citations = extract_citations("\n".join(answers))
+        exporter.add(build_record(domain, data_type, initial_prompt, conversation_history, summary, citations, usage))
     
     return filepath
 
-def process_multiple_domains_data_types(domains, data_types, num_iterations, output_dir):
+def process_multiple_domains_data_types(domains, data_types, num_iterations, output_dir, export_path=None, refresh=False):
     os.makedirs(output_dir, exist_ok=True)
     results = []
+    # Optionally collect every result into one consolidated dataset as well as the markdown files
+    exporter = DatasetExporter(export_path) if export_path else None
+    writer = OutputWriter()
 
-    for domain in domains:
-        for data_type in data_types:
-            try:
-                filepath = process_domain_data_type(domain, data_type, num_iterations, output_dir)
-                results.append((domain, data_type, filepath))
-                print(f"Generated markdown for {domain} - {data_type}: {filepath}")
-            except Exception as e:
-                print(f"Error processing {domain} - {data_type}: {str(e)}")
+    try:
+        for domain in domains:
+            for data_type in data_types:
+                try:
+                    filepath = process_domain_data_type(domain, data_type, num_iterations, output_dir, exporter, writer, refresh)
+                    results.append((domain, data_type, filepath))
+                    print(f"Generated markdown for {domain} - {data_type}: {filepath}")
+                except Exception as e:
+                    print(f"Error processing {domain} - {data_type}: {str(e)}")
+    finally:
+        writer.commit()
+        if exporter is not None:
+            exporter.flush()
 
     return results
 
@@ -140,8 +305,17 @@ if __name__ == "__main__":
     data_types = ["demographic"]
     num_iterations = 3
     output_dir = "output_markdown_files"
+    export_path = "output_dataset/results.jsonl.gz"
+    # Set to True to refresh existing results, re-researching only stale sections
+    refresh = False
+
+    results = process_multiple_domains_data_types(domains[:1], data_types, num_iterations, output_dir, export_path, refresh)
 
-    results = process_multiple_domains_data_types(domains[:1], data_types, num_iterations, output_dir)
+    # Set RESEARCH_TRACE=1 to record a timeline of the run
+    if process_trace is not None:
+        trace_path = os.environ.get("RESEARCH_TRACE_FILE", "research_trace.json")
+        process_trace.export(trace_path)
+        print(f"Trace written to {trace_path}")
 
     print("\nSummary of generated files:")
     for domain, data_type, filepath in results:
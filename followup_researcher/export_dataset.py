@@ -0,0 +1,151 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import time
+import uuid
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.citation_index import extract_citations
+from common.output_writer import SUMMARY_HEADING, is_complete_output, result_identity
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+TITLE_PREFIX = "# Adversarial conversation on Question: "
+# Role headings written by create_markdown_document
+TURN_HEADING = re.compile(r'^## (Online Model|Offline Model)\n\n', re.MULTILINE)
+
+
+def build_record(domain, data_type, initial_prompt, conversation, summary, citations, usage):
+    """One dataset row for a researched domain and data type."""
+    return {
+        "domain": domain,
+        "data_type": data_type,
+        "initial_prompt": initial_prompt,
+        "conversation": [{"role": message["role"], "content": message["content"]} for message in conversation],
+        "summary": summary,
+        "citations": list(citations),
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "timestamp": int(time.time())
+    }
+
+
+def append_jsonl(path, records):
+    """Append records to a .jsonl.gz file, compressing each row as its own gzip member.
+
+    Concatenated gzip members form a valid gzip stream, so the file can be appended to
+    across runs and still be read with gzip.open or zcat.
+    """
+    with open(path, 'ab') as f:
+        for record in records:
+            f.write(gzip.compress((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')))
+
+
+def append_parquet(path, records):
+    """Append records to a Parquet dataset directory as a new zstd-compressed part file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(path, exist_ok=True)
+    part = os.path.join(path, f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet")
+    pq.write_table(pa.Table.from_pylist(records), part, compression="zstd")
+
+
+def parse_markdown_document(content):
+    """Recover (initial_prompt, conversation, summary) from a result file written by create_markdown_document."""
+    if not content.startswith(TITLE_PREFIX) or not is_complete_output(content):
+        return None
+    body, summary = content.split(f"\n{SUMMARY_HEADING}\n\n", 1)
+    initial_prompt = body[len(TITLE_PREFIX):].split("\n", 1)[0]
+    parts = TURN_HEADING.split(body)
+    conversation = [
+        {"role": "assistant" if role == "Online Model" else "user", "content": text.strip()}
+        for role, text in zip(parts[1::2], parts[2::2])
+    ]
+    return initial_prompt, conversation, summary.strip()
+
+
+def export_directory(output_dir, path):
+    """Export complete result files that were written before the dataset existed (or outside it).
+
+    The batch job only exports results it generates, so run this once to backfill a
+    dataset with older files. Token usage of those runs is unknown and recorded as zero.
+    """
+    exported = 0
+    with DatasetExporter(path) as exporter:
+        for filename in sorted(os.listdir(output_dir)):
+            if not filename.endswith(".md"):
+                continue
+            with open(os.path.join(output_dir, filename), 'r', encoding='utf-8') as f:
+                content = f.read()
+            parsed = parse_markdown_document(content)
+            if parsed is None:
+                continue
+            initial_prompt, conversation, summary = parsed
+            domain, data_type = result_identity(filename, content)
+            answers = "\n".join(message["content"] for message in conversation if message["role"] == "assistant")
+            exporter.add(build_record(domain, data_type, initial_prompt, conversation, summary, extract_citations(answers), {}))
+            exported += 1
+    return exported
+
+
+def read_jsonl(path):
+    """Iterate over the records in a .jsonl.gz export."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class DatasetExporter:
+    """Buffer result rows and append them to a single export in batches.
+
+    Paths ending in .parquet are written as a Parquet dataset directory when pyarrow is
+    installed; without it the exporter falls back to gzip-compressed JSONL next to the
+    requested path, so buffered rows are never lost at flush time.
+    """
+
+    def __init__(self, path, batch_size=100):
+        if path.endswith(".parquet") and pyarrow is None:
+            fallback = path[:-len(".parquet")] + ".jsonl.gz"
+            print(f"pyarrow is not installed; exporting to {fallback} instead of {path}")
+            path = fallback
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.path.endswith(".parquet"):
+            append_parquet(self.path, self.pending)
+        else:
+            append_jsonl(self.path, self.pending)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the consolidated dataset from existing result files.")
+    parser.add_argument("output_dir")
+    parser.add_argument("path", help="export path (.jsonl.gz, or .parquet with pyarrow)")
+    args = parser.parse_args()
+    print(f"Exported {export_directory(args.output_dir, args.path)} results")
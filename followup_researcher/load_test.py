@@ -0,0 +1,242 @@
+"""Load test for the data broker research app against a local stand-in backend.
+
+Drives simulated Streamlit sessions through the Research flow with AppTest, replacing
+Perplexity, OpenAI embeddings and Pinecone with in-process fakes that sleep for a
+configurable latency, and reports per-session latency, throughput and memory.
+
+    python load_test.py --sessions 50 --concurrency 10 --latency 0.5
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_adversarial_researcher.py")
+APP_PASSWORD = "load-test"
+EMBEDDING_DIMENSIONS = 256
+
+# Keep the app's local state (quota bucket, search index, citations) out of the real files,
+# and let the quota scheduler pass requests straight through
+WORK_DIR = tempfile.mkdtemp(prefix="researcher-load-test-")
+os.environ.setdefault("PPLX_QUOTA_DB", os.path.join(WORK_DIR, "quota.sqlite"))
+os.environ.setdefault("PPLX_REQUESTS_PER_MINUTE", "1000000")
+os.environ.setdefault("PPLX_BUCKET_CAPACITY", "1000000")
+os.environ.setdefault("SEARCH_DB", os.path.join(WORK_DIR, "search.sqlite"))
+os.environ.setdefault("OUTPUT_DIR", os.path.join(WORK_DIR, "output_markdown_files"))
+os.environ.setdefault("RESULT_STORE_DIR", os.path.join(WORK_DIR, "results"))
+
+SECRETS = {
+    "PPLX_API_KEY": "stub",
+    "OPENAI_API_KEY": "stub",
+    "PINECONE_API_KEY": "stub",
+    "app_password": APP_PASSWORD
+}
+
+
+class StubLatency:
+    def __init__(self, mean_seconds):
+        self.mean_seconds = mean_seconds
+
+    def sleep(self):
+        if self.mean_seconds > 0:
+            # Lognormal, so a few calls are much slower than the mean like real API calls
+            time.sleep(random.lognormvariate(math.log(self.mean_seconds), 0.5))
+
+
+class StubPerplexityResponse:
+    def __init__(self, content, stream):
+        self.content = content
+        self.stream = stream
+        self.status_code = 200
+        self.ok = True
+
+    def json(self):
+        return {
+            "choices": [{"message": {"content": self.content}}],
+            "usage": {"prompt_tokens": 500, "completion_tokens": len(self.content) // 4}
+        }
+
+    def iter_lines(self, decode_unicode=True):
+        words = self.content.split(" ")
+        for i in range(0, len(words), 20):
+            chunk = {"choices": [{"delta": {"content": " ".join(words[i:i + 20]) + " "}}]}
+            yield "data: " + json.dumps(chunk)
+        yield "data: " + json.dumps({"choices": [{"delta": {}}], "usage": self.json()["usage"]})
+        yield "data: [DONE]"
+
+
+def stub_perplexity_post(latency):
+    """A replacement for requests.post that answers Perplexity chat completions locally."""
+    def post(url, json=None, headers=None, timeout=None, stream=False, **kwargs):
+        latency.sleep()
+        model = (json or {}).get("model", "")
+        if "online" in model:
+            n = random.randint(0, 10 ** 6)
+            content = ("The company collects data from partners, surveys and public records. " * 40
+                       + f"\n\n1. https://example.com/source-{n}\n2. https://example.org/report-{n}")
+        elif "summary" in str((json or {}).get("messages", [{}])[0]).lower():
+            content = "The company combines partner data, surveys and public records. " * 5
+        else:
+            content = "Which partners supply the data and how often is it refreshed?"
+        return StubPerplexityResponse(content, stream)
+    return post
+
+
+class StubEmbeddings:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def create(self, model=None, input=None, encoding_format=None, dimensions=EMBEDDING_DIMENSIONS):
+        self.latency.sleep()
+        seed = int(hashlib.sha256(input[0].encode()).hexdigest(), 16)
+        rng = random.Random(seed)
+        vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+        norm = math.sqrt(sum(x * x for x in vector))
+        item = types.SimpleNamespace(embedding=[x / norm for x in vector])
+        return types.SimpleNamespace(data=[item])
+
+
+class StubIndex:
+    """In-memory stand-in for a Pinecone index, supporting the calls pinecone_utils makes."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.vectors = {}
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors):
+        self.latency.sleep()
+        with self.lock:
+            for id, values, metadata in vectors:
+                self.vectors[id] = (values, metadata)
+
+    def query(self, vector, filter=None, top_k=1, include_metadata=True):
+        self.latency.sleep()
+        min_timestamp = (filter or {}).get("timestamp", {}).get("$gte", 0)
+        with self.lock:
+            items = list(self.vectors.items())
+        matches = [
+            {"id": id, "score": sum(a * b for a, b in zip(vector, values)), "metadata": metadata}
+            for id, (values, metadata) in items
+            if metadata["timestamp"] >= min_timestamp
+        ]
+        matches.sort(key=lambda match: match["score"], reverse=True)
+        return {"matches": matches[:top_k]}
+
+
+def install_secrets():
+    """Provide the app's secrets through a secrets.toml in the working directory.
+
+    AppTest.secrets swaps the global st.secrets for the duration of each run, which is not
+    safe with sessions running concurrently, so the secrets are loaded from a file instead.
+    This has to happen before streamlit is imported.
+    """
+    os.makedirs(os.path.join(WORK_DIR, ".streamlit"), exist_ok=True)
+    with open(os.path.join(WORK_DIR, ".streamlit", "secrets.toml"), 'w', encoding='utf-8') as f:
+        for key, value in SECRETS.items():
+            f.write(f'{key} = "{value}"\n')
+    os.chdir(WORK_DIR)
+    # Let the app import its sibling modules the way `streamlit run` would
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+
+
+def install_stubs(latency):
+    """Replace the external services before the app is first imported."""
+    import requests
+    requests.post = stub_perplexity_post(latency)
+
+    index = StubIndex(latency)
+    pinecone = types.ModuleType("pinecone")
+    pinecone.Pinecone = lambda api_key=None: types.SimpleNamespace(Index=lambda name: index)
+    sys.modules["pinecone"] = pinecone
+
+    openai = types.ModuleType("openai")
+    openai.OpenAI = lambda api_key=None: types.SimpleNamespace(embeddings=StubEmbeddings(latency))
+    sys.modules["openai"] = openai
+
+
+def text_input(at, label_prefix):
+    return next(widget for widget in at.text_input if widget.label.startswith(label_prefix))
+
+
+def run_session(session_id, timeout):
+    """Log in and run one Research request; returns (seconds, error, session state size in bytes)."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    text_input(at, "Enter password").input(APP_PASSWORD)
+    at.run()
+    text_input(at, "Enter the data provider").input(f"Broker{session_id}")
+    text_input(at, "Enter the data category").input("demographic")
+    at.run()
+
+    start = time.perf_counter()
+    research = next(button for button in at.button if button.label == "Research")
+    research.click().run()
+    seconds = time.perf_counter() - start
+
+    error = at.exception[0].message if at.exception else None
+    state_bytes = sum(
+        len(value.encode()) if isinstance(value, str) else sys.getsizeof(value)
+        for value in (at.session_state[key] for key in ("qa_result_key", "summary_key") if key in at.session_state)
+    )
+    return seconds, error, state_bytes
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_load_test(sessions, concurrency, latency, timeout):
+    install_secrets()
+    install_stubs(StubLatency(latency))
+
+    # Warm up imports so the first measured session does not pay for them
+    run_session("warmup", timeout)
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: run_session(i, timeout), range(sessions)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = [seconds for seconds, error, _ in results if error is None]
+    errors = [error for _, error, _ in results if error is not None]
+    return {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "stub_latency_s": latency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_s": round(statistics.median(latencies), 3) if latencies else None,
+        "p95_s": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "throughput_sessions_per_s": round(sessions / elapsed, 3),
+        "peak_memory_per_concurrent_session_kb": round((peak - baseline) / concurrency / 1024, 1),
+        "session_state_kb": round(statistics.mean(size for _, _, size in results) / 1024, 1)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the research app against a stubbed backend.")
+    parser.add_argument("--sessions", type=int, default=20, help="total simulated sessions")
+    parser.add_argument("--concurrency", type=int, default=5, help="sessions running at once")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean stub latency per backend call in seconds")
+    parser.add_argument("--timeout", type=float, default=300, help="per-run AppTest timeout in seconds")
+    args = parser.parse_args()
+
+    print(json.dumps(run_load_test(args.sessions, args.concurrency, args.latency, args.timeout), indent=2))
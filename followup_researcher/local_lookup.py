@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from common.output_writer import SUMMARY_HEADING, is_complete_output
+
+# Summaries kept in memory by the app process, shared by every session
+LRU_MAX_ENTRIES = int(os.environ.get("SUMMARY_LRU_MAX_ENTRIES", 512))
+# Batch results older than this are not served, matching the vector cache's age limit
+LOCAL_MAX_AGE_DAYS = int(os.environ.get("LOCAL_RESULT_MAX_AGE_DAYS", 30))
+
+TIERS = ("memory", "local", "vector", "generated")
+
+tier_stats = {tier: {"count": 0, "seconds": 0.0} for tier in TIERS}
+tier_stats_lock = threading.Lock()
+
+
+def normalize_key(value):
+    return " ".join(str(value).lower().split())
+
+
+def result_key(domain, data_type):
+    return normalize_key(domain), normalize_key(data_type)
+
+
+def extract_summary(content):
+    """The advertiser summary from a complete result document, or None."""
+    if not is_complete_output(content):
+        return None
+    return content.split(SUMMARY_HEADING, 1)[1].split("\n## ", 1)[0].strip()
+
+
+class SummaryLRU:
+    """Recently used summaries, each served for max_age_days after it was stored."""
+
+    def __init__(self, max_entries=LRU_MAX_ENTRIES, max_age_days=LOCAL_MAX_AGE_DAYS):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 86400
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, domain, data_type):
+        key = result_key(domain, data_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored, summary = entry
+            if time.time() - stored > self.max_age_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return summary
+
+    def put(self, domain, data_type, summary):
+        key = result_key(domain, data_type)
+        with self.lock:
+            self.entries[key] = (time.time(), summary)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def filename_key(domain, data_type):
+    # Matched on the whole '{domain}_{data_type}' stem, since either part may contain "_"
+    return normalize_key(f"{domain}_{data_type}")
+
+
+class LocalResultIndex:
+    """Batch result files in an output directory, keyed by their normalized '{domain}_{data_type}' stem.
+
+    The directory is only rescanned when its mtime changes, i.e. when the batch job adds,
+    replaces or removes a file, so a lookup is normally a dict access and one stat.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.dir_mtime = None
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            dir_mtime = os.stat(self.output_dir).st_mtime
+        except FileNotFoundError:
+            dir_mtime = None
+        with self.lock:
+            if dir_mtime == self.dir_mtime:
+                return
+            paths = {}
+            if dir_mtime is not None:
+                for entry in os.scandir(self.output_dir):
+                    if entry.name.endswith(".md"):
+                        paths[normalize_key(entry.name[:-len(".md")])] = entry.path
+            self.paths = paths
+            self.dir_mtime = dir_mtime
+
+    def get(self, domain, data_type):
+        self.refresh()
+        path = self.paths.get(filename_key(domain, data_type))
+        if path is None:
+            return None
+        try:
+            if time.time() - os.stat(path).st_mtime > LOCAL_MAX_AGE_DAYS * 86400:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return extract_summary(f.read())
+        except FileNotFoundError:
+            return None
+
+
+def record_tier(tier, seconds):
+    with tier_stats_lock:
+        tier_stats[tier]["count"] += 1
+        tier_stats[tier]["seconds"] += seconds
+
+
+def tier_report():
+    """How lookups were served since startup, with the mean time spent in each tier."""
+    with tier_stats_lock:
+        total = sum(stats["count"] for stats in tier_stats.values())
+        return {
+            tier: {
+                "count": stats["count"],
+                "share": stats["count"] / total if total else 0.0,
+                "mean_ms": round(stats["seconds"] / stats["count"] * 1000, 3) if stats["count"] else None
+            }
+            for tier, stats in tier_stats.items()
+        }
@@ -0,0 +1,27 @@
+# Models this tool routes to; shared routing logic is in common/model_routing.py.
+# Tools import route_models and record_latency from here so the tables are installed first.
+from common.model_routing import configure, route_models, record_latency
+
+# Context window (tokens) and a starting latency estimate (seconds) for each model
+MODELS = {
+    "llama-3.1-sonar-small-128k-online": {"tier": "small", "context": 127072, "latency": 6.0},
+    "llama-3.1-sonar-large-128k-online": {"tier": "large", "context": 127072, "latency": 15.0},
+    "llama-3.1-sonar-small-128k-chat": {"tier": "small", "context": 127072, "latency": 2.0},
+    "llama-3.1-sonar-large-128k-chat": {"tier": "large", "context": 127072, "latency": 6.0},
+    "llama-3-sonar-large-32k-chat": {"tier": "large", "context": 32768, "latency": 6.0},
+}
+
+# Models to try for each pipeline stage, in order of preference. Later entries are
+# fallbacks when a call fails, the prompt does not fit, or the latency budget is tight.
+STAGE_ROUTES = {
+    "research": ["llama-3.1-sonar-large-128k-online", "llama-3.1-sonar-small-128k-online"],
+    "follow_up": ["llama-3.1-sonar-small-128k-chat", "llama-3.1-sonar-large-128k-chat"],
+    "summarize": ["llama-3-sonar-large-32k-chat", "llama-3.1-sonar-large-128k-chat"],
+}
+
+# Per-stage latency budgets in seconds; stages without a budget always keep their preferred model.
+STAGE_LATENCY_BUDGETS = {
+    "follow_up": 10.0,
+}
+
+configure(MODELS, STAGE_ROUTES, STAGE_LATENCY_BUDGETS)
@@ -4,12 +4,26 @@ from openai import OpenAI
 from typing import Dict, Any, List
 from datetime import datetime, timedelta
 import hashlib
+import threading
+from common.tracing import traced
 
 pc = Pinecone(api_key=st.secrets.PINECONE_API_KEY)
 cache_index = pc.Index('researcher-cache')
 
 openai_client = OpenAI(api_key=st.secrets.OPENAI_API_KEY)
 
+# Cache tuning, overridable through secrets.toml
+CACHE_SIMILARITY_THRESHOLD = float(st.secrets.get("CACHE_SIMILARITY_THRESHOLD", 0.95))
+CACHE_TOP_K = int(st.secrets.get("CACHE_TOP_K", 5))
+CACHE_MAX_AGE_DAYS = int(st.secrets.get("CACHE_MAX_AGE_DAYS", 30))
+
+# Updated from every session's thread, so always under cache_stats_lock
+cache_stats = {"hits": 0, "misses": 0, "false_hits": 0}
+cache_stats_lock = threading.Lock()
+
+# Text returned in place of an answer by older versions of send_perplexity_message
+ERROR_SENTINEL = "Error: Unable to get a response"
+
 
 def generate_embedding(text: str) -> list[float]:
     """Generate an embedding for the given text."""
@@ -35,8 +49,16 @@ def generate_id(text: str) -> str:
     """Generate a hash ID from the given text."""
     return hashlib.sha256(text.encode()).hexdigest()
 
-def cache_summary(domain: str, data_type: str, initial_prompt: str, summary: str):
-    """Cache the summary in Pinecone with a timestamp."""
+def is_valid_summary(summary: str) -> bool:
+    """Reject empty summaries and summaries produced from failed LLM calls."""
+    return bool(summary and summary.strip()) and ERROR_SENTINEL not in summary
+
+@traced("cache_store")
+def cache_summary(domain: str, data_type: str, initial_prompt: str, summary: str) -> bool:
+    """Cache the summary in Pinecone with a timestamp, refusing invalid summaries."""
+    if not is_valid_summary(summary):
+        print(f"Not caching invalid summary for {domain} - {data_type}")
+        return False
     embedding = generate_embedding(initial_prompt)
     id = generate_id(initial_prompt)
     metadata = {
@@ -47,20 +69,65 @@ def cache_summary(domain: str, data_type: str, initial_prompt: str, summary: str
         "timestamp": int(datetime.now().timestamp())
     }
     cache_index.upsert(vectors=[(id, embedding, metadata)])
+    return True
+
+@traced("cache_lookup")
+def get_cached_summary(initial_prompt: str, domain: str = None, data_type: str = None):
+    """Retrieve a cached summary from Pinecone, filtering for recent entries.
 
-def get_cached_summary(initial_prompt: str):
-    """Retrieve a cached summary from Pinecone, filtering for recent entries."""
+    The top CACHE_TOP_K candidates above the similarity threshold are reranked by
+    checking that their domain and data_type metadata match the request, so a
+    differently named broker with similar phrasing is not served as a hit.
+    """
     embedding = generate_embedding(initial_prompt)
         
     # Query Pinecone with the embedding and timestamp filter
     results = query_pinecone(
         query_embedding=embedding,
-        top_k=1,
+        top_k=CACHE_TOP_K,
         presearch_filter={
-            "timestamp": {"$gte": int((datetime.now() - timedelta(days=30)).timestamp())}
+            "timestamp": {"$gte": int((datetime.now() - timedelta(days=CACHE_MAX_AGE_DAYS)).timestamp())}
         }
     )
 
-    if results['matches'] and results['matches'][0]['score'] > 0.95:
-        return results['matches'][0]['metadata']
-    return None
\ No newline at end of file
+    candidates = [match for match in results['matches'] if match['score'] >= CACHE_SIMILARITY_THRESHOLD]
+    for match in candidates:
+        if metadata_matches(match['metadata'], domain, data_type) and is_valid_summary(match['metadata'].get('summary')):
+            count_lookup("hits")
+            return match['metadata']
+
+    count_lookup("false_hits" if candidates else "misses")
+    return None
+
+def count_lookup(outcome: str) -> None:
+    with cache_stats_lock:
+        cache_stats[outcome] += 1
+
+def normalize_key(value: str) -> str:
+    """Normalize a domain or data_type value for metadata comparison."""
+    return " ".join(str(value).lower().split())
+
+def metadata_matches(metadata: Dict[str, Any], domain: str = None, data_type: str = None) -> bool:
+    """Check that a cached entry was generated for the same domain and data_type."""
+    if domain is not None and normalize_key(metadata.get("domain", "")) != normalize_key(domain):
+        return False
+    if data_type is not None and normalize_key(metadata.get("data_type", "")) != normalize_key(data_type):
+        return False
+    return True
+
+def cache_report() -> Dict[str, Any]:
+    """Summarize cache lookups since startup.
+
+    A false hit is a lookup whose only candidates above the similarity threshold
+    belonged to a different domain or data_type and were rejected by the rerank.
+    """
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    lookups = sum(stats.values())
+    return {
+        **stats,
+        "lookups": lookups,
+        "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+        "similarity_threshold": CACHE_SIMILARITY_THRESHOLD,
+        "top_k": CACHE_TOP_K,
+    }
@@ -0,0 +1,93 @@
+import contextvars
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from common.novelty import URL_PATTERN
+
+# Start drafting the follow-up once this much of the online answer has streamed in,
+# or as soon as the answer reaches its list of URLs
+SPECULATION_MIN_CHARS = 1500
+# Keep a draft only if the text it saw covers this share of the final answer's prose
+SPECULATION_MIN_COVERAGE = 0.8
+
+# A list item that is a URL, i.e. the answer has reached its sources
+URL_LIST_ITEM = re.compile(r'^\s*(?:[-*]|\d+\.)\s*\S*https?://', re.MULTILINE)
+
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pipelining")
+
+
+def submit(fn, *args):
+    # Run in the caller's context so tracing spans land in the caller's trace
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def read_stream(response, on_partial):
+    """Read a streamed chat completion, reporting the text so far after every chunk.
+
+    Returns the same shape as a non-streamed response body so callers can treat both alike.
+    """
+    parts = []
+    usage = {}
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        usage = chunk.get("usage") or usage
+        delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+        if delta:
+            parts.append(delta)
+            on_partial("".join(parts))
+    return {"choices": [{"message": {"content": "".join(parts)}}], "usage": usage}
+
+
+def prose_length(text):
+    return len(URL_PATTERN.sub("", text).strip())
+
+
+class SpeculativeDraft:
+    """Draft the next follow-up question from a partial online answer.
+
+    update() is passed as the streaming callback; once enough of the answer has arrived the
+    draft is started in the background. A retried or rerouted request streams from the start
+    again, so a partial that no longer extends the drafted text resets the draft. result()
+    keeps the draft when the final answer begins with the text it was based on and that text
+    covers most of the answer, and otherwise discards it and drafts again from the full
+    answer, so a speculative call is the only cost of a miss.
+    """
+
+    def __init__(self, draft_fn, min_chars=SPECULATION_MIN_CHARS, min_coverage=SPECULATION_MIN_COVERAGE):
+        self.draft_fn = draft_fn
+        self.min_chars = min_chars
+        self.min_coverage = min_coverage
+        self.prefix = None
+        self.future = None
+
+    def update(self, partial):
+        if self.prefix is not None and not partial.startswith(self.prefix):
+            self.reset()
+        if self.future is None and (len(partial) >= self.min_chars or URL_LIST_ITEM.search(partial)):
+            self.prefix = partial
+            self.future = submit(self.draft_fn, partial)
+
+    def result(self, final):
+        if (self.future is not None and final.startswith(self.prefix)
+                and prose_length(self.prefix) >= self.min_coverage * prose_length(final)):
+            try:
+                return self.future.result()
+            except Exception:
+                pass
+        self.cancel()
+        return self.draft_fn(final)
+
+    def reset(self):
+        self.cancel()
+        self.prefix = None
+        self.future = None
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
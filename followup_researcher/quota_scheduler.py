@@ -0,0 +1,102 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+# Shared by every process using the same Perplexity key on this machine
+QUOTA_DB = os.environ.get("PPLX_QUOTA_DB", os.path.join(tempfile.gettempdir(), "pplx_quota.sqlite"))
+REQUESTS_PER_MINUTE = float(os.environ.get("PPLX_REQUESTS_PER_MINUTE", 50))
+BUCKET_CAPACITY = float(os.environ.get("PPLX_BUCKET_CAPACITY", 10))
+
+# Batch work only takes a token while this fraction of the bucket stays free for interactive use
+BATCH_RESERVE = 0.3
+# Interactive waiters older than this are assumed to belong to a dead process
+WAITER_TTL_SECONDS = 120
+
+PRIORITIES = ("interactive", "batch")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS waiters (
+    id TEXT PRIMARY KEY,
+    priority TEXT NOT NULL,
+    since REAL NOT NULL
+);
+"""
+
+
+def connect(db_path=QUOTA_DB):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT OR IGNORE INTO bucket (id, tokens, updated) VALUES (1, ?, ?)", (BUCKET_CAPACITY, time.time()))
+    return conn
+
+
+def refill(conn, now):
+    tokens, updated = conn.execute("SELECT tokens, updated FROM bucket WHERE id = 1").fetchone()
+    return min(BUCKET_CAPACITY, tokens + (now - updated) * REQUESTS_PER_MINUTE / 60)
+
+
+def try_acquire(conn, priority):
+    """Take one token if the priority allows it right now."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        tokens = refill(conn, now)
+        if priority == "interactive":
+            allowed = tokens >= 1
+        else:
+            interactive_waiting = conn.execute(
+                "SELECT COUNT(*) FROM waiters WHERE priority = 'interactive' AND since > ?",
+                (now - WAITER_TTL_SECONDS,)
+            ).fetchone()[0]
+            allowed = not interactive_waiting and tokens >= 1 + BUCKET_CAPACITY * BATCH_RESERVE
+        if allowed:
+            tokens -= 1
+        conn.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+        conn.execute("COMMIT")
+        return allowed
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def acquire(priority="batch", timeout=None, db_path=QUOTA_DB):
+    """Block until a request may be sent under the shared quota.
+
+    Interactive callers register as waiting so batch callers stop taking tokens until
+    they are served; batch callers only use capacity above the interactive reserve.
+    Returns False if the timeout expires first.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    conn = connect(db_path)
+    waiter_id = uuid.uuid4().hex
+    deadline = time.time() + timeout if timeout is not None else None
+    try:
+        if priority == "interactive":
+            conn.execute("INSERT INTO waiters (id, priority, since) VALUES (?, ?, ?)", (waiter_id, priority, time.time()))
+        while not try_acquire(conn, priority):
+            if deadline is not None and time.time() >= deadline:
+                return False
+            # Sleep roughly one token interval, with jitter so processes do not poll in lockstep
+            time.sleep(60 / REQUESTS_PER_MINUTE * random.uniform(0.5, 1.5))
+        return True
+    finally:
+        conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+        conn.close()
+
+
+def report_rate_limited(db_path=QUOTA_DB):
+    """Empty the bucket after a 429 so every process backs off together."""
+    conn = connect(db_path)
+    try:
+        conn.execute("UPDATE bucket SET tokens = 0, updated = ? WHERE id = 1", (time.time(),))
+    finally:
+        conn.close()
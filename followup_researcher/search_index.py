@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import time
+from common.output_writer import result_identity
+
+SEARCH_DB = os.environ.get("SEARCH_DB", "search_index.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    domain TEXT NOT NULL,
+    data_type TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    path UNINDEXED, domain, data_type, content, tokenize='porter unicode61'
+);
+"""
+
+
+def connect(db_path=SEARCH_DB):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def index_document(path, content, domain, data_type, kind="document", mtime=None, db_path=SEARCH_DB):
+    """Add or replace a document in the full-text index."""
+    mtime = mtime if mtime is not None else time.time()
+    with connect(db_path) as conn:
+        conn.execute("DELETE FROM documents_fts WHERE path = ?", (path,))
+        conn.execute(
+            "INSERT INTO documents_fts (path, domain, data_type, content) VALUES (?, ?, ?, ?)",
+            (path, domain, data_type, content)
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (path, domain, data_type, kind, mtime) VALUES (?, ?, ?, ?, ?)",
+            (path, domain, data_type, kind, mtime)
+        )
+
+
+def sync_directory(output_dir, db_path=SEARCH_DB):
+    """Bring the index up to date with an output directory, reading only new or modified files."""
+    if not os.path.isdir(output_dir):
+        return 0
+    with connect(db_path) as conn:
+        indexed = dict(conn.execute("SELECT path, mtime FROM documents WHERE kind = 'document'").fetchall())
+
+    updated = 0
+    present = set()
+    for entry in os.scandir(output_dir):
+        if not entry.name.endswith(".md"):
+            continue
+        present.add(entry.path)
+        mtime = entry.stat().st_mtime
+        if indexed.get(entry.path) == mtime:
+            continue
+        with open(entry.path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        domain, data_type = result_identity(entry.name, content)
+        index_document(entry.path, content, domain, data_type, mtime=mtime, db_path=db_path)
+        updated += 1
+
+    removed = [path for path in indexed if path.startswith(os.path.join(output_dir, "")) and path not in present]
+    if removed:
+        with connect(db_path) as conn:
+            conn.executemany("DELETE FROM documents_fts WHERE path = ?", [(path,) for path in removed])
+            conn.executemany("DELETE FROM documents WHERE path = ?", [(path,) for path in removed])
+    return updated
+
+
+def fts_query(text):
+    # Quote every term so user input cannot be parsed as FTS5 syntax
+    return " ".join('"%s"' % term.replace('"', '""') for term in text.split())
+
+
+def search(text, limit=20, db_path=SEARCH_DB):
+    """Full-text search over indexed research, best matches first."""
+    if not text.strip():
+        return []
+    with connect(db_path) as conn:
+        rows = conn.execute(
+            "SELECT path, domain, data_type, snippet(documents_fts, 3, '**', '**', ' ... ', 24), content "
+            "FROM documents_fts WHERE documents_fts MATCH ? ORDER BY rank LIMIT ?",
+            (fts_query(text), limit)
+        ).fetchall()
+    return [
+        {"path": path, "domain": domain, "data_type": data_type, "snippet": snippet, "content": content}
+        for path, domain, data_type, snippet, content in rows
+    ]
@@ -1,6 +1,25 @@
+import json
+import os
+from contextlib import nullcontext
 import streamlit as st
 import requests
-from pinecone_utils import get_cached_summary, cache_summary
+import time
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.novelty import has_new_information
+from quota_scheduler import acquire, report_rate_limited
+from common.budget import RunBudget
+from common.tracing import span, traced, start_trace
+from pipelining import SpeculativeDraft, read_stream
+from search_index import index_document, sync_directory, search
+from common.output_writer import INITIAL_PROMPT
+from common.citation_index import record_citations
+from pinecone_utils import get_cached_summary, cache_summary, cache_report
+from common.result_store import put_text, get_text
+from local_lookup import SummaryLRU, LocalResultIndex, record_tier, tier_report
 
 
 # Constants for system prompts
@@ -10,10 +29,25 @@ OFFLINE_SYSTEM_PROMPT = """You are an AI assistant who is trying to get specific
 from a conversation partner who is connected to the internet. Your **ONLY** concern is the accuracy of the data, because 
 you are investigating on behalf of advertisers who are paying for the data."""
 
+# Batch output directory included in the research search
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "output_markdown_files")
+
+# Lookup tiers in front of the Pinecone cache, shared by every session of this process
+summary_lru = SummaryLRU()
+local_results = LocalResultIndex(OUTPUT_DIR)
+
+FOLLOW_UP_PROMPT = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
+
 SUMMARY_PROMPT = "Be precise and concise. Only provide the summary, without restating the question, or giving additional context or explanation. Make the summary sound like a natural, human explanation rather than a marketing spiel."    
 
 
-def send_perplexity_message(conversation_history, model, system_prompt):
+# Priority of this process when sharing the Perplexity quota with the batch job
+QUOTA_PRIORITY = "interactive"
+
+# Default limits for one research run, overridable in secrets.toml
+DEFAULT_RUN_BUDGET = {"max_tokens": 100000, "max_seconds": 180, "max_calls": 8}
+
+def send_perplexity_message(conversation_history, model, system_prompt, on_partial=None, budget=None):
     url = "https://api.perplexity.ai/chat/completions"
     
     messages = [{"role": "system", "content": system_prompt}] + conversation_history
@@ -23,48 +57,116 @@ def send_perplexity_message(conversation_history, model, system_prompt):
         "messages": messages
     }
     
+    # Stream the answer when the caller wants to see it as it arrives
+    if on_partial is not None:
+        payload["stream"] = True
+    
     headers = {
         "accept": "application/json",
         "content-type": "application/json",
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
+    error = None
+    for attempt in range(MAX_RETRIES):
+        acquire(QUOTA_PRIORITY)
+        try:
+            with span("perplexity_request", model=model, attempt=attempt, streamed=on_partial is not None):
+                response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS, stream=on_partial is not None)
+                if on_partial is not None and response.ok:
+                    response_data = read_stream(response, on_partial)
+            if on_partial is None or not response.ok:
+                with span("parse_response"):
+                    response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            if budget is not None:
+                budget.charge(response_data.get('usage', {}).get('prompt_tokens', 0), response_data.get('usage', {}).get('completion_tokens', 0))
+            choices = response_data.get('choices') or [{}]
+            content = choices[0].get('message', {}).get('content')
+            if content and content.strip():
+                return content
+            print(response_data)
+            error = response_data
+            if response.status_code == 429:
+                report_rate_limited()
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
     
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        return response_data['choices'][0]['message']['content']
-    else:
-        print(response_data)
-        return "Error: Unable to get a response from the LLM"
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
 
-def create_conversation(domain, data_type, num_iterations=3):
-    online_model = "llama-3.1-sonar-large-128k-online"
-    offline_model = "llama-3.1-sonar-large-128k-chat"
-    
+def send_stage_message(stage, conversation_history, system_prompt, on_partial=None, budget=None):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + "".join(message["content"] for message in conversation_history)
+    error = None
+    with span(stage) as attributes:
+        for model in route_models(stage, prompt_text):
+            attributes["model"] = model
+            start = time.time()
+            try:
+                return send_perplexity_message(conversation_history, model, system_prompt, on_partial=on_partial, budget=budget)
+            except PerplexityError as e:
+                error = e
+            finally:
+                record_latency(model, time.time() - start)
+    raise error
+
+def generate_follow_up(conversation, budget=None):
+    offline_conversation = conversation + [{"role": "user", "content": FOLLOW_UP_PROMPT}]
+    return send_stage_message("follow_up", offline_conversation, OFFLINE_SYSTEM_PROMPT, budget=budget)
+
+def create_conversation(domain, data_type, num_iterations=3, early_stop=True, pipelined=False, budget=None):
     online_conversation = []
     offline_conversation = []
     display_conversation = []
     
     # Initial query
-    initial_prompt = f"Answer this question: how does {domain} collect {data_type} data that it sells to advertisers?"
+    initial_prompt = INITIAL_PROMPT.format(domain=domain, data_type=data_type)
     online_conversation.append({"role": "user", "content": initial_prompt})
     display_conversation.append({"role": "user", "content": initial_prompt})
     
+    previous_responses = []
+    
+    # num_iterations is an upper bound; with early_stop the loop ends once answers stop adding information
     for i in range(num_iterations):
-        # Get response from online model
-        online_response = send_perplexity_message(online_conversation, online_model, ONLINE_SYSTEM_PROMPT)
+        # In pipelined mode, draft the next follow-up question while the answer is still streaming
+        speculation = None
+        if pipelined and i < num_iterations - 1:
+            history = list(online_conversation)
+            speculation = SpeculativeDraft(lambda partial, history=history: generate_follow_up(history + [{"role": "assistant", "content": partial}], budget=budget))
+        
+        # Get response from online model, sending only recent history once the budget is half spent
+        request_history = budget.trim_history(online_conversation) if budget is not None else online_conversation
+        online_response = send_stage_message("research", request_history, ONLINE_SYSTEM_PROMPT, on_partial=speculation.update if speculation else None, budget=budget)
         online_conversation.append({"role": "assistant", "content": online_response})
         display_conversation.append({"role": "assistant", "content": online_response})
         
         # Update offline conversation
         offline_conversation = online_conversation.copy()
         
+        # Stop once the online model repeats itself without new sources
+        if early_stop and not has_new_information(online_response, previous_responses):
+            if speculation is not None:
+                speculation.cancel()
+            break
+        previous_responses.append(online_response)
+        
+        # Skip further follow-up rounds and go to the summary once the budget runs low
+        if budget is not None and budget.near_limit():
+            if speculation is not None:
+                speculation.cancel()
+            break
+        
         if i < num_iterations - 1:
-            # Generate follow-up question using offline model
-            follow_up_prompt = "Based on the previous conversation, generate a follow-up question to get more specific information. Phrase it as if you're the original user seeking clarification. Only provide the question, without any additional context or explanation."
-            offline_conversation.append({"role": "user", "content": follow_up_prompt})
-            follow_up_question = send_perplexity_message(offline_conversation, offline_model, OFFLINE_SYSTEM_PROMPT)
+            # Generate follow-up question using offline model, reusing the speculative draft when it holds up
+            if speculation is not None:
+                follow_up_question = speculation.result(online_response)
+            else:
+                follow_up_question = generate_follow_up(online_conversation, budget=budget)
             
             # Add follow-up question to conversations
             online_conversation.append({"role": "user", "content": follow_up_question})
@@ -72,7 +174,7 @@ def create_conversation(domain, data_type, num_iterations=3):
     
     return offline_conversation, initial_prompt
 
-def summarize_conversation(initial_prompt, conversation_history):
+def summarize_conversation(initial_prompt, conversation_history, budget=None):
     summary_prompt = f"""Based on the following conversation about '{initial_prompt}', provide a concise summary for a non-technical advertiser. 
     Focus on answering the initial question and find a single answer to satisfy the question. Keep it brief and easy to understand.
 
@@ -81,12 +183,14 @@ def summarize_conversation(initial_prompt, conversation_history):
 
     Summary:"""
     
-    summary = send_perplexity_message([{"role": "user", "content": summary_prompt}], "llama-3-sonar-large-32k-chat", SUMMARY_PROMPT)
+    summary = send_stage_message("summarize", [{"role": "user", "content": summary_prompt}], SUMMARY_PROMPT, budget=budget)
     return summary
 
-def create_markdown_document(initial_prompt, conversation_history):
+@traced("render_markdown")
+def create_markdown_document(initial_prompt, conversation_history, summary=None):
     # Generate summary first
-    summary = summarize_conversation(initial_prompt, conversation_history)
+    if summary is None:
+        summary = summarize_conversation(initial_prompt, conversation_history)
     
     # Create markdown document with summary at the top
     markdown = f"## Summary for Advertisers\n\n{summary}\n\n"
@@ -98,6 +202,62 @@ def create_markdown_document(initial_prompt, conversation_history):
     
     return markdown
 
+def run_research(domain, data_type, initial_prompt, num_iterations):
+    # Generate fresh research into session state; failed LLM calls are reported and nothing is cached
+    with st.spinner("Processing..."):
+        budget = RunBudget(**st.secrets.get("RUN_BUDGET", DEFAULT_RUN_BUDGET))
+        try:
+            conversation_history, _ = create_conversation(domain, data_type, num_iterations, pipelined=True, budget=budget)
+            summary = summarize_conversation(initial_prompt, conversation_history, budget)
+        except PerplexityError as e:
+            st.error(f"Research failed, please try again: {e}")
+            return False
+        qa_result = create_markdown_document(initial_prompt, conversation_history, summary)
+        # Session state only holds keys into the shared result store
+        st.session_state.summary_key = put_text(summary)
+        st.session_state.qa_result_key = put_text(qa_result)
+        # Cache the new summary
+        cache_summary(domain, data_type, initial_prompt, summary)
+        summary_lru.put(domain, data_type, summary)
+        index_document(f"app/{domain}_{data_type}.md", qa_result, domain, data_type, kind="app")
+        record_citations(domain, data_type, [message["content"] for message in conversation_history if message["role"] == "assistant"])
+    st.caption(f"Budget used: {budget.report()}")
+    return True
+
+@traced("summary_lookup")
+def lookup_summary(initial_prompt, domain, data_type):
+    """Find an existing summary in the fastest tier that has one.
+
+    Tiers are the in-memory LRU, then batch results in OUTPUT_DIR by exact (domain, data_type),
+    then the Pinecone semantic cache. Returns (summary, tier), or (None, None) on a miss.
+    """
+    start = time.perf_counter()
+    tier = "memory"
+    summary = summary_lru.get(domain, data_type)
+    if summary is None:
+        tier = "local"
+        summary = local_results.get(domain, data_type)
+    if summary is None:
+        tier = "vector"
+        cached_summary = get_cached_summary(initial_prompt, domain, data_type)
+        summary = cached_summary['summary'] if cached_summary else None
+    if summary is None:
+        return None, None
+    record_tier(tier, time.perf_counter() - start)
+    if tier != "memory":
+        summary_lru.put(domain, data_type, summary)
+    return summary, tier
+
+def show_trace_panel(trace):
+    with st.expander("Run timeline"):
+        st.dataframe(trace.timeline())
+        st.download_button(
+            "Download Trace (Chrome JSON)",
+            json.dumps(trace.to_chrome()),
+            file_name="research_trace.json",
+            mime="application/json"
+        )
+
 def main():
     st.title("Data Broker Research")
 
@@ -107,52 +267,71 @@ def main():
         return  # Exit the main function if the password is incorrect
     
     # Initialize session state
-    if 'qa_result' not in st.session_state:
-        st.session_state.qa_result = None
-    if 'summary' not in st.session_state:
-        st.session_state.summary = None
+    if 'qa_result_key' not in st.session_state:
+        st.session_state.qa_result_key = None
+    if 'summary_key' not in st.session_state:
+        st.session_state.summary_key = None
     if 'cached_summary' not in st.session_state:
         st.session_state.cached_summary = None
     if 'show_regenerate' not in st.session_state:
         st.session_state.show_regenerate = False
 
+    with st.expander("Search existing research"):
+        search_text = st.text_input("Search previous research before starting a new one:")
+        if search_text:
+            sync_directory(OUTPUT_DIR)
+            results = search(search_text)
+            if not results:
+                st.write("No matching research found.")
+            for result in results:
+                st.markdown(f"**{result['domain']} - {result['data_type']}**: {result['snippet']}")
+                if st.checkbox("Show full document", key=f"show_{result['path']}"):
+                    st.markdown(result['content'])
+
     domain = st.text_input("Enter the data provider name (e.g. Acxiom, Lotame, Oracle, Ameribase, Skydeo etc.):")
     data_type = st.text_input("Enter the data category (e.g. behavioral, demographic) or segment (e.g. coffee drinker enthusiast, frequent traveler, etc.):")
     num_iterations = 3
     
-    initial_prompt = f"Answer this question: how does {domain} collect {data_type} data that it sells to advertisers?"
+    initial_prompt = INITIAL_PROMPT.format(domain=domain, data_type=data_type)
     
-    if st.button("Research"):
-        st.session_state.show_regenerate = False
-        cached_summary = get_cached_summary(initial_prompt)
-        
-        if cached_summary:
-            st.session_state.summary = cached_summary['summary']
-            st.session_state.qa_result = None
-            st.session_state.show_regenerate = True
-            st.info("Displaying cached summary. Click 'Generate New Research' for fresh results and full research document.")
-            st.markdown(st.session_state.summary)
-        else:
-            with st.spinner("Processing..."):
-                conversation_history, _ = create_conversation(domain, data_type, num_iterations)
-                st.session_state.qa_result = create_markdown_document(initial_prompt, conversation_history)
-                st.session_state.summary = summarize_conversation(initial_prompt, conversation_history)
-                # Cache the new summary
-                cache_summary(domain, data_type, initial_prompt, st.session_state.summary)
-
-    if st.session_state.show_regenerate:
-        if st.button("Generate New Research"):
-            with st.spinner("Processing..."):
-                conversation_history, _ = create_conversation(domain, data_type, num_iterations)
-                st.session_state.qa_result = create_markdown_document(initial_prompt, conversation_history)
-                st.session_state.summary = summarize_conversation(initial_prompt, conversation_history)
-                # Cache the new summary
-                cache_summary(domain, data_type, initial_prompt, st.session_state.summary)
+    # Spans are only recorded when the timeline was asked for
+    show_trace = st.sidebar.checkbox("Show run timeline")
+    with (start_trace() if show_trace else nullcontext()) as trace:
+        if st.button("Research"):
             st.session_state.show_regenerate = False
+            start = time.perf_counter()
+            cached_summary, tier = lookup_summary(initial_prompt, domain, data_type)
+        
+            if cached_summary:
+                st.session_state.summary_key = put_text(cached_summary)
+                st.session_state.qa_result_key = None
+                st.session_state.show_regenerate = True
+                st.info("Displaying cached summary. Click 'Generate New Research' for fresh results and full research document.")
+                st.caption(f"Served from the {tier} cache")
+                st.markdown(cached_summary)
+            elif run_research(domain, data_type, initial_prompt, num_iterations):
+                record_tier("generated", time.perf_counter() - start)
+
+        if st.session_state.show_regenerate:
+            if st.button("Generate New Research"):
+                if run_research(domain, data_type, initial_prompt, num_iterations):
+                    st.session_state.show_regenerate = False
 
     
-    if st.session_state.qa_result:
-        st.markdown(st.session_state.qa_result)
+        if st.session_state.qa_result_key:
+            qa_result = get_text(st.session_state.qa_result_key)
+            if qa_result is None:
+                # Evicted after the session sat idle
+                st.info("This research result has expired. Click 'Research' to load it again.")
+                st.session_state.qa_result_key = None
+            else:
+                st.markdown(qa_result)
+
+    if trace is not None:
+        show_trace_panel(trace)
+
+    with st.sidebar.expander("Cache statistics"):
+        st.json({"tiers": tier_report(), "vector_cache": cache_report()})
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
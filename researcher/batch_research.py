@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.budget import RunBudget
+from common.pipeline import Pipeline
+from common.batch import normalize, unique, logged, topic_filepath, write_topic, run_topics
+from common.citation_index import record_citations
+from researcher import (
+    SUMMARY_PROMPT, request_overview, extract_overview, extract_subtopics, research_subtopic,
+    generate_summary, create_markdown_document, create_summary_markdown
+)
+
+# Topics decompose and research concurrently across the whole batch
+BATCH_MAX_WORKERS = 8
+MAX_SUBTOPICS = 10
+
+
+def pair_key(pair):
+    topic, subtopic = pair
+    return normalize(topic), normalize(subtopic)
+
+
+def build_batch_pipeline(output_dir, budget=None):
+    """decompose every topic -> research each (topic, subtopic) once -> summarize and write each topic.
+
+    Subtopics are always researched in the context of their topic, so two topics raising the
+    same subtopic each get their own answer; a topic repeating a subtopic researches it once.
+    """
+    def subtopic_lists(overview_responses):
+        return [unique(extract_subtopics(response, MAX_SUBTOPICS)) if response is not None else [] for response in overview_responses]
+
+    def research_pairs(topics, subtopic_lists):
+        return [(topic, subtopic) for topic, subtopics in zip(topics, subtopic_lists) for subtopic in subtopics]
+
+    def research_data_by_topic(topics, overview_responses, subtopic_lists, pairs, subtopic_info):
+        info_for = {pair_key(pair): info for pair, info in zip(pairs, subtopic_info)}
+        documents = []
+        for topic, overview_response, subtopics in zip(topics, overview_responses, subtopic_lists):
+            if overview_response is None:
+                print(f"Skipping {topic}: no overview")
+                continue
+            infos = [info_for[pair_key((topic, subtopic))] for subtopic in subtopics]
+            documents.append((topic, [extract_overview(overview_response)] + [info for info in infos if info is not None]))
+        return documents
+
+    def summarize_and_write(document):
+        # Each topic is written as soon as its summary is in, so a later failure loses nothing
+        topic, research_data = document
+        summary = generate_summary(research_data, SUMMARY_PROMPT, topic, budget)
+        filepath = topic_filepath(output_dir, topic)
+        write_topic(filepath, create_summary_markdown(topic, summary) + "\n\n" + create_markdown_document(topic, research_data))
+        record_citations(topic, "", research_data)
+        print(f"Generated markdown for {topic}: {filepath}")
+        return topic, filepath
+
+    pipeline = Pipeline(inputs=("topics",), name="batch", max_workers=BATCH_MAX_WORKERS)
+    pipeline.add("decompose", logged("decompose", lambda topic: request_overview(topic, MAX_SUBTOPICS, budget)), map_over="topics", retries=1)
+    pipeline.add("subtopics", subtopic_lists, deps=("decompose",))
+    pipeline.add("unique", research_pairs, deps=("topics", "subtopics"))
+    pipeline.add("research", logged("research", lambda pair: research_subtopic(pair[1], pair[0], budget)), map_over="unique", retries=1, cached=True)
+    pipeline.add("documents", research_data_by_topic, deps=("topics", "decompose", "subtopics", "unique", "research"))
+    pipeline.add("summarize", logged("summarize", summarize_and_write, lambda document: repr(document[0])), map_over="documents", retries=1)
+    return pipeline
+
+
+def run_batch(topics, output_dir, budget=None):
+    """Research every topic in one batch and write one file (summary, then full research) per topic."""
+    return run_topics(build_batch_pipeline(output_dir, budget), topics, output_dir, "subtopics")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Research a file of topics, one per line, in one batch.")
+    parser.add_argument("topics_file")
+    parser.add_argument("--output-dir", default="output_markdown_files")
+    args = parser.parse_args()
+
+    with open(args.topics_file, 'r', encoding='utf-8') as f:
+        topics = [line.strip() for line in f]
+
+    budget = RunBudget()
+    written = run_batch(topics, args.output_dir, budget)
+    print(f"\n{len(written)} topics written; budget used: {budget.report()}")
@@ -1,21 +1,42 @@
-import re
+import json
+from contextlib import nullcontext
 import streamlit as st
 import requests
+import time
 # import anthropic
 from openai import OpenAI
+import os
+import sys
+# Modules shared by all the research tools live in common/ at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_routes import route_models, record_latency
+from common.perplexity import PerplexityError, MAX_RETRIES, RETRY_BACKOFF_SECONDS, REQUEST_TIMEOUT_SECONDS
+from common.budget import RunBudget
+from common.tracing import span, start_trace, traced
+from common.list_parsing import list_response_format, parse_json_object, parse_list_response
+from common.result_store import put_text, get_text
+from common.pipeline import Pipeline
+from common.section_store import refreshed, section_key
+from common.map_reduce import map_reduce_summary
+from common.citation_index import record_citations
 
 
-def send_perplexity_message(message, conversation_history, model="llama-3-sonar-large-32k-online", system_prompt=""):
+# Default limits for a research run started from the app, overridable in secrets.toml
+DEFAULT_RUN_BUDGET = {"max_tokens": 150000, "max_seconds": 240, "max_calls": 12}
+
+
+def send_perplexity_message(message, conversation_history, model="llama-3-sonar-large-32k-online", system_prompt="", response_format=None, budget=None):
     url = "https://api.perplexity.ai/chat/completions"
     
-    conversation_history.append({"role": "user", "content": message})
-    
+    question = {"role": "user", "content": message}
     payload = {
         "model": model,
         "messages": [
             {"role": "system", "content": system_prompt}
-        ] + conversation_history
+        ] + conversation_history + [question]
     }
+    if response_format:
+        payload["response_format"] = response_format
     
     headers = {
         "accept": "application/json",
@@ -23,48 +44,121 @@ def send_perplexity_message(message, conversation_history, model="llama-3-sonar-
         "authorization": f"Bearer {st.secrets['PPLX_API_KEY']}"
     }
     
-    response = requests.post(url, json=payload, headers=headers)
-    response_data = response.json()
-    
-    if 'choices' in response_data and len(response_data['choices']) > 0:
-        ai_response = response_data['choices'][0]['message']['content']
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        return ai_response
-    else:
-        return "Error: Unable to get a response from the API"
-
-
-def extract_subtopics(text):
-    # Extract numbered list items
-    subtopics = re.findall(r'\d+\.\s*(.*)', text)
-    return subtopics
-
-def research_topic(main_topic, max_subtopics=10):
-    conversation_history = []
-    research_prompt = "Conclude your response with a list of URLs used from your search."
-    
-    # Step 1: Get overview
-    overview = send_perplexity_message(f"Provide an overview of {main_topic} with a numbered list of around 5 subtopics.", conversation_history, system_prompt=research_prompt)
-    
-    # Step 2: Extract subtopics
-    subtopics = extract_subtopics(overview)[:max_subtopics]
-    
-    # Step 3: Research each subtopic
-    detailed_research = [overview]
-    for subtopic in subtopics:
-        subtopic_info = send_perplexity_message(f"Provide detailed information about {subtopic} in the context of {main_topic}.", conversation_history, system_prompt=research_prompt)
-        detailed_research.append(subtopic_info)
-    
-    # Step 4: Create markdown document
-    markdown_doc = create_markdown_document(main_topic, detailed_research)
-    
-    # Step 5: Generate summary
-    summary_prompt = "Be precise and concise."
-    summary = generate_summary(detailed_research, summary_prompt, main_topic)
-    summary_markdown = create_summary_markdown(main_topic, summary)
+    error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            with span("perplexity_request", model=model, attempt=attempt):
+                response = requests.post(url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+            with span("parse_response"):
+                response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            error = e
+        else:
+            if budget is not None:
+                usage = response_data.get('usage', {})
+                budget.charge(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+            choices = response_data.get('choices') or [{}]
+            ai_response = choices[0].get('message', {}).get('content')
+            if ai_response and ai_response.strip():
+                # The history only ever grows by answered user/assistant pairs
+                conversation_history.extend([question, {"role": "assistant", "content": ai_response}])
+                return ai_response
+            error = response_data
+            # Client errors other than rate limiting will not succeed on retry
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                break
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
     
-    return markdown_doc, summary_markdown
+    raise PerplexityError(f"Unable to get a response from {model}: {error}")
+
+
+def send_stage_message(stage, message, conversation_history, system_prompt="", response_format=None, budget=None):
+    # Try the models routed for this stage in order, falling back when a call fails
+    prompt_text = system_prompt + message + "".join(turn["content"] for turn in conversation_history)
+    error = None
+    with span(stage) as attributes:
+        for model in route_models(stage, prompt_text):
+            attributes["model"] = model
+            start = time.time()
+            try:
+                return send_perplexity_message(message, conversation_history, model=model, system_prompt=system_prompt, response_format=response_format, budget=budget)
+            except PerplexityError as e:
+                error = e
+            finally:
+                record_latency(model, time.time() - start)
+    raise error
+
+def extract_subtopics(text, max_subtopics=None):
+    # Prefer the structured "subtopics" field, falling back to the first numbered list
+    return parse_list_response(text, "subtopics", max_subtopics)
+
+def extract_overview(text):
+    # Render a structured overview response back into markdown for the research document
+    data = parse_json_object(text)
+    if not isinstance(data, dict) or not isinstance(data.get("overview"), str):
+        return text
+    subtopics = extract_subtopics(text)
+    return data["overview"] + "\n\n" + "\n".join(f"{i}. {subtopic}" for i, subtopic in enumerate(subtopics, 1))
+
+RESEARCH_PROMPT = "Conclude your response with a list of URLs used from your search."
+SUMMARY_PROMPT = "Be precise and concise."
+
+def request_overview(main_topic, max_subtopics, budget=None):
+    overview_format = list_response_format("subtopics", max_subtopics, extra_properties={"overview": {"type": "string"}})
+    return send_stage_message(
+        "research",
+        f"Provide an overview of {main_topic} with a list of around 5 subtopics. Respond in JSON with an \"overview\" string, ending with the list of URLs, and a \"subtopics\" list.",
+        [],
+        system_prompt=RESEARCH_PROMPT,
+        response_format=overview_format,
+        budget=budget
+    )
+
+def research_subtopic(subtopic, main_topic, budget=None):
+    # Skip remaining subtopics once the budget runs low, leaving room for the summary
+    if budget is not None and budget.near_limit():
+        return None
+    return send_stage_message("research", f"Provide detailed information about {subtopic} in the context of {main_topic}.", [], system_prompt=RESEARCH_PROMPT, budget=budget)
 
+def build_research_pipeline(max_subtopics=10, budget=None, refresh=False):
+    # Keep one call of the budget for the summary
+    if budget is not None:
+        max_subtopics = budget.limit_items(max_subtopics, reserved=1)
+
+    def research_data(overview_response, subtopic_info):
+        return [extract_overview(overview_response)] + [info for info in subtopic_info if info is not None]
+
+    # Every section is stored; with refresh, stored sections that are still fresh are reused
+    # and only stale or low-confidence ones are researched again
+    def decompose(main_topic):
+        return refreshed(main_topic, "overview", lambda: request_overview(main_topic, max_subtopics, budget), refresh, label="Overview", position=0)
+
+    def research(subtopic, main_topic, subtopics):
+        # Sections are stored in document order: the overview first, then each subtopic
+        return refreshed(main_topic, f"subtopic {section_key(subtopic)}", lambda: research_subtopic(subtopic, main_topic, budget), refresh,
+                         label=subtopic, position=subtopics.index(subtopic) + 1)
+
+    pipeline = Pipeline(inputs=("main_topic",), name="research")
+    pipeline.add("decompose", decompose, deps=("main_topic",), retries=1)
+    pipeline.add("subtopics", lambda overview_response: extract_subtopics(overview_response, max_subtopics), deps=("decompose",))
+    # Subtopics are researched in parallel, no more at once than the budget has calls left for;
+    # the section store is the only cache for researched sections
+    pipeline.add("research", research, deps=("main_topic", "subtopics"), map_over="subtopics", retries=1,
+                 max_parallel=budget.calls_left if budget is not None else None)
+    pipeline.add("render", lambda main_topic, overview_response, subtopic_info: create_markdown_document(main_topic, research_data(overview_response, subtopic_info)), deps=("main_topic", "decompose", "research"))
+    pipeline.add("summarize", lambda main_topic, overview_response, subtopic_info: generate_summary(research_data(overview_response, subtopic_info), SUMMARY_PROMPT, main_topic, budget), deps=("main_topic", "decompose", "research"))
+    pipeline.add("render_summary", create_summary_markdown, deps=("main_topic", "summarize"))
+    return pipeline
+
+def research_topic(main_topic, max_subtopics=10, budget=None, refresh=False):
+    # The summary is always regenerated, from the mix of reused and fresh sections
+    results = build_research_pipeline(max_subtopics, budget, refresh).run(main_topic=main_topic)
+    # Topics have no data category, so citations are recorded under an empty data_type
+    record_citations(main_topic, "", [results["render"]])
+    return results["render"], results["render_summary"]
+
+@traced("render_markdown")
 def create_markdown_document(topic, research_data):
     markdown = f"# Research on {topic}\n\n"
     markdown += "## Overview\n\n"
@@ -76,15 +170,18 @@ def create_markdown_document(topic, research_data):
     
     return markdown
 
-def generate_summary(research_data, summary_prompt, main_topic):
-    summary_request = f"Can you extract the most relevant valuable information from the research that specifically addresses the main topic: '{main_topic}'.\n\n Here is the research:\n\n" + "\n\n".join(research_data)
-    summary = send_perplexity_message(
-        summary_request,
-        [],
-        model="llama-3-70b-instruct",
-        system_prompt=summary_prompt
-    )
-    return summary
+def generate_summary(research_data, summary_prompt, main_topic, budget=None):
+    request_prefix = f"Can you extract the most relevant valuable information from the research that specifically addresses the main topic: '{main_topic}'.\n\n Here is the research:\n\n"
+    condense_prefix = f"Extract the information from this part of the research that addresses the main topic: '{main_topic}'. Keep specific facts and the URLs of sources.\n\n"
+
+    def condense(sections):
+        return send_stage_message("summarize", condense_prefix + "\n\n".join(sections), [], system_prompt=summary_prompt, budget=budget)
+
+    def summarize(sections):
+        return send_stage_message("summarize", request_prefix + "\n\n".join(sections), [], system_prompt=summary_prompt, budget=budget)
+
+    # Research too long for one prompt is condensed in parallel chunks first
+    return map_reduce_summary(research_data, condense, summarize, overhead_text=summary_prompt + request_prefix, budget=budget)
 
 # def generate_summary_claude(research_data, summary_prompt):
 #     client = anthropic.Anthropic(api_key=st.secrets['ANTHROPIC_API_KEY'])
@@ -124,15 +221,52 @@ def generate_summary_openai(research_data, summary_prompt, main_topic):
 def create_summary_markdown(topic, summary):
     return f"# Summary of Research on {topic}\n\n{summary}"
 
+def show_trace_panel(trace):
+    with st.expander("Run timeline"):
+        st.dataframe(trace.timeline())
+        st.download_button(
+            "Download Trace (Chrome JSON)",
+            json.dumps(trace.to_chrome()),
+            file_name="research_trace.json",
+            mime="application/json"
+        )
+
 # Streamlit app
 def main():
     st.title("Research Assistant")
+    show_trace = st.sidebar.checkbox("Show run timeline")
     
+    # Results live in the shared result store; session state only holds their keys,
+    # so the documents survive reruns (e.g. a download click) without a copy per session
+    if 'research_key' not in st.session_state:
+        st.session_state.research_key = None
+    if 'summary_key' not in st.session_state:
+        st.session_state.summary_key = None
+
     topic = st.text_input("Enter a research topic:")
+    refresh = st.checkbox("Only refresh stale sections", help="Reuse stored sections that are recent and cite sources")
     if st.button("Start Research"):
-        with st.spinner("Researching..."):
-            research_result, summary_result = research_topic(topic)
-        
+        budget = RunBudget(**st.secrets.get("RUN_BUDGET", DEFAULT_RUN_BUDGET))
+        # Spans are only recorded when the timeline was asked for
+        try:
+            with st.spinner("Researching..."), (start_trace() if show_trace else nullcontext()) as trace:
+                research_result, summary_result = research_topic(topic, budget=budget, refresh=refresh)
+            st.caption(f"Budget used: {budget.report()}")
+            if show_trace:
+                show_trace_panel(trace)
+            st.session_state.research_key = put_text(research_result)
+            st.session_state.summary_key = put_text(summary_result)
+        except PerplexityError as e:
+            st.error(f"An error occurred during research: {str(e)}")
+
+    research_result = get_text(st.session_state.research_key)
+    summary_result = get_text(st.session_state.summary_key)
+    if st.session_state.research_key and (research_result is None or summary_result is None):
+        # Evicted after the session sat idle
+        st.info("This research has expired. Click 'Start Research' to run it again.")
+        st.session_state.research_key = None
+        st.session_state.summary_key = None
+    elif research_result:
         st.markdown("## Full Research")
         st.markdown(research_result)
         st.download_button(